@@ -10,17 +10,26 @@ import socket
 import time
 import hashlib
 import threading
+import asyncio
+import concurrent.futures
 import random
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 import sys
 import math
 import wave
-import array
 import progressbar
 import argparse
 import cairo
 import logging
+import queue
+import shutil
+import tempfile
+import platform
+import itertools
+import json
+import bisect
+from collections import OrderedDict
 
 # Setup basic logging (will be configured properly after parsing arguments)
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s')
@@ -42,24 +51,284 @@ def genSine(freq=2000, volume=100, duration=3, phase=0, sampleRate=88200):
     sine_wave = sine_wave * ((32767.0 / 100.0) * volume)
     return (sine_wave, t[-1])
 
-def create_spectrogram(text=None, image_path=None, output_file="spectrogram.wav", font_size=50, hflip=0, invert=1, 
-                      sampleRate=8000, duration=0.10, maxpixelwidth=256, min_freq=450, max_freq=2700, progress_callback=None, mode="USB", rotation=0):
-    # Log rotation value for debugging
-    logging.debug(f"Rotation value: {rotation} degrees")
-    output_dir = os.path.dirname(os.path.abspath(output_file))
-    temp_text_image = os.path.join(output_dir, 'text_image.png')
-    
-    font_files = [
-        '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
-        '/usr/share/fonts/TTF/DejaVuSans.ttf',
-        '/usr/share/fonts/dejavu/DejaVuSans.ttf',
-        '/usr/share/fonts/truetype/freefont/FreeSans.ttf',
-        '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf',
-        '/usr/share/fonts/truetype/ttf-dejavu/DejaVuSans.ttf'
-    ]
-    
+def genSineBank(freqs, volumes, phases, duration=3, sampleRate=88200):
+    """genSine() for every column at once: returns (one row of samples per tone, next phases)."""
+    numSamples = int(sampleRate * duration)
+    t = np.arange(numSamples) + np.asarray(phases)[:, None]
+    sine_wave = np.interp((np.asarray(freqs)[:, None] * t) % sampleRate, np.arange(SINE_TABLE_SIZE) * (sampleRate / SINE_TABLE_SIZE), sine_table)
+    edge_size = int(numSamples * 0.15)
+    window = np.ones(numSamples)
+    edge = np.blackman(edge_size * 2)
+    window[:edge_size] = edge[:edge_size]
+    window[-edge_size:] = edge[edge_size:]
+    sine_wave = sine_wave * window
+    sine_wave = sine_wave * ((32767.0 / 100.0) * np.asarray(volumes))[:, None]
+    return (sine_wave, t[:, -1])
+
+PACK_ALIGNMENTS = ('start', 'center', 'end')
+
+class RenderCancelled(Exception):
+    """Raised inside the pipeline when a render's CancellationToken is cancelled."""
+
+class CancellationToken:
+    """Cooperative cancellation flag checked by the pipeline between rows."""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def check(self):
+        if self.event.is_set():
+            raise RenderCancelled()
+
+class StageCache:
+    """Small LRU cache holding the results of one pipeline stage."""
+
+    def __init__(self, name, size=4):
+        self.name = name
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Filled from the GUI's background renders as well as the main pipeline
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                logging.debug(f"{self.name} stage: cache hit")
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# Widest image (in pixels, i.e. tones) that is synthesized
+MAX_PIXEL_WIDTH = 256
+
+# Decoded and downscaled source images, keyed by file content
+_decode_cache = StageCache('decode', 8)
+
+# File digests, keyed by path, modification time and size so an unchanged
+# file isn't hashed again on every preview update
+_digest_cache = StageCache('digest', 32)
+
+def file_digest(path):
+    """Return the SHA-1 hex digest of a file's content."""
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+    cached = _digest_cache.get(key)
+    if cached is not None:
+        return cached
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return _digest_cache.put(key, digest.hexdigest())
+
+def decode_image(image_path, max_width=MAX_PIXEL_WIDTH, rotation=0):
+    """Decode an image file to 'L', rotated and downscaled to at most max_width pixels wide.
+
+    Large sources are decoded at reduced size (JPEG draft mode, then an
+    integer box reduce) before the final resample, so only a fraction of the
+    full-resolution pixels are ever produced.  Results are cached per file
+    content.
+    """
+    key = (file_digest(image_path), max_width, rotation)
+    cached = _decode_cache.get(key)
+    if cached is not None:
+        return cached.copy()
+
+    im = Image.open(image_path)
+    width, height = im.size
+    # Width after rotation is what has to fit into max_width
+    out_width = height if rotation in (90, 270) else width
+    if max_width and out_width > max_width:
+        r = float(max_width) / float(out_width)
+        target = (max(int(width * r), 1), max(int(height * r), 1))
+        # Let the decoder scale down by 1/2, 1/4 or 1/8 (no-op for non-JPEG)
+        im.draft('L', target)
+        im = im.convert('L')
+        # Cheap integer reduction down to no less than twice the target size,
+        # leaving the final step to the higher quality resampling filter
+        factor = min(im.size[0] // target[0], im.size[1] // target[1]) // 2
+        if factor > 1:
+            im = im.reduce(factor)
+        logging.debug(f"Decoded {image_path} at {im.size} for target {target} (source {width}x{height})")
+        im = im.resize(target)
+    else:
+        im = im.convert('L')
+
+    if rotation == 90:
+        im = im.transpose(Image.ROTATE_90)
+    elif rotation == 180:
+        im = im.transpose(Image.ROTATE_180)
+    elif rotation == 270:
+        im = im.transpose(Image.ROTATE_270)
+
+    return _decode_cache.put(key, im).copy()
+
+# Light 3x3 smoothing kernel with more weight on the center pixel
+SMOOTHING_KERNEL = np.array([
+    [0.03, 0.05, 0.03],
+    [0.05, 0.68, 0.05],
+    [0.03, 0.05, 0.03]
+])
+
+def iter_image_bands(im, tile_rows=None, halo=0):
+    """Yield (first_row, last_row, first_halo_row, pixels) for horizontal bands of an 'L' image."""
+    width, height = im.size
+    band_height = tile_rows if tile_rows and tile_rows > 0 else max(height, 1)
+    for r0 in range(0, height, band_height):
+        r1 = min(r0 + band_height, height)
+        h0 = max(r0 - halo, 0)
+        h1 = min(r1 + halo, height)
+        pixels = np.asarray(im.crop((0, h0, width, h1)), dtype=np.int64)
+        yield r0, r1, h0, pixels
+
+def image_statistics(im, tile_rows=None):
+    """Compute the thresholds used by preprocessing, one band at a time."""
+    width, height = im.size
+    if width * height == 0:
+        return {
+            'min_val': 0, 'max_val': 0, 'mean_val': 0.0,
+            'noise_threshold': 2.0,  # Default if no pixel data
+            'contrast_factor': 10.0,  # Default contrast
+            'midpoint': 50.0,  # Default midpoint
+        }
+
+    min_val = None
+    max_val = None
+    total = 0
+    for _, _, _, pixels in iter_image_bands(im, tile_rows):
+        band_min = pixels.min()
+        band_max = pixels.max()
+        min_val = band_min if min_val is None else min(min_val, band_min)
+        max_val = band_max if max_val is None else max(max_val, band_max)
+        total += int(pixels.sum())
+    # Integer sum keeps the mean identical to a single pass over the whole image
+    mean_val = np.float64(total) / (width * height)
+
+    # Log the image statistics for debugging
+    logging.debug(f"Image statistics - Min: {min_val}, Max: {max_val}, Mean: {mean_val}")
+
+    # Calculate dynamic noise threshold based on image content
+    noise_threshold = min_val + ((max_val - min_val) * 0.03)  # 3% above minimum
+
+    # Calculate contrast enhancement parameters based on image statistics
+    # For low contrast images, use more aggressive enhancement
+    dynamic_range = max_val - min_val
+    if dynamic_range < 100:  # Low contrast image
+        contrast_factor = 15.0  # More aggressive contrast
+        midpoint = mean_val  # Use mean as midpoint
+    else:
+        contrast_factor = 10.0  # Standard contrast
+        midpoint = 50.0  # Standard midpoint
+
+    logging.debug(f"Dynamic noise threshold: {noise_threshold}")
+    logging.debug(f"Contrast factor: {contrast_factor}, Midpoint: {midpoint}")
+    return {
+        'min_val': min_val, 'max_val': max_val, 'mean_val': mean_val,
+        'noise_threshold': noise_threshold,
+        'contrast_factor': contrast_factor,
+        'midpoint': midpoint,
+    }
+
+def preprocess_pixels(pixels, stats, invert):
+    """Normalize, invert and contrast-enhance a block of pixels to 0-120 volumes."""
+    min_val = stats['min_val']
+    max_val = stats['max_val']
+
+    # Normalize to 0-100 range based on the image's dynamic range
+    if max_val > min_val:
+        normalized = ((pixels - min_val) / (max_val - min_val)) * 100.0
+    else:
+        normalized = np.zeros(pixels.shape)
+
+    if invert:
+        normalized = 100.0 - normalized
+
+    # Apply contrast enhancement - make it more black and white
+    # Use a sigmoid function to create a sharper transition
+    enhanced = 100.0 / (1.0 + np.exp(-stats['contrast_factor'] * (normalized - stats['midpoint']) / 100.0))
+    return enhanced * 1.2
+
+def iter_smoothed_rows(im, stats, invert, tile_rows=None):
+    """Yield preprocessed and smoothed image rows, working in bands of tile_rows.
+
+    Each band is decoded with a one-row halo so the 3x3 kernel sees the same
+    neighbours as it would on the full image; the output is identical for any
+    tile size.
+    """
+    width, height = im.size
+    for r0, r1, h0, pixels in iter_image_bands(im, tile_rows, halo=1):
+        processed = preprocess_pixels(pixels, stats, invert)
+        smoothed = np.copy(processed)
+
+        # Apply a light blur only to reduce noise; the outer rows and columns
+        # of the whole image are left untouched
+        lo = max(r0, 1) - h0
+        hi = min(r1, height - 1) - h0
+        if hi > lo and width > 2:
+            val = 0
+            for kh in range(3):
+                for kw in range(3):
+                    val = val + processed[lo + kh - 1:hi + kh - 1, kw:width - 2 + kw] * SMOOTHING_KERNEL[kh, kw]
+            smoothed[lo:hi, 1:width - 1] = val
+
+        for row in smoothed[r0 - h0:r1 - h0]:
+            yield row
+
+# One cache per stage: render -> decode/resize/rotate -> preprocess -> synthesize -> encode
+_font_cache = {}
+_render_cache = StageCache('render', 16)
+_image_cache = StageCache('image', 8)
+_preprocess_cache = StageCache('preprocess', 8)
+_synthesize_cache = StageCache('synthesize', 4)
+# Spectral layout of a render -> its synthesize stage key, for finding the other sideband
+_sideband_index = StageCache('sideband', 8)
+_encoded_files = {}
+
+FONT_FILES = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/TTF/DejaVuSans.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/freefont/FreeSans.ttf',
+    '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf',
+    '/usr/share/fonts/truetype/ttf-dejavu/DejaVuSans.ttf'
+]
+
+def image_digest(im):
+    """Return a digest identifying an image's mode, size and pixels."""
+    digest = hashlib.sha1(f"{im.mode}{im.size}".encode('utf-8'))
+    digest.update(im.tobytes())
+    return digest.hexdigest()
+
+def load_font(font_size):
+    """Load the first available TrueType font at font_size, falling back to PIL's default."""
+    if font_size in _font_cache:
+        return _font_cache[font_size]
+
     font = None
-    for font_file in font_files:
+    for font_file in FONT_FILES:
         try:
             if os.path.exists(font_file):
                 font = ImageFont.truetype(font_file, font_size)
@@ -68,282 +337,2090 @@ def create_spectrogram(text=None, image_path=None, output_file="spectrogram.wav"
             continue
     
     if font is None:
-        try:
-            font = ImageFont.load_default()
-        except Exception as e:
-            print(f"Error: Could not load any fonts - {e}")
-            return False
+        font = ImageFont.load_default()
+    _font_cache[font_size] = font
+    return font
+
+def render_text_image(text, font_size=50, hflip=0):
+    """Render text to a black and white 'L' image, rotated for transmission."""
+    key = (text, font_size, hflip)
+    cached = _render_cache.get(key)
+    if cached is not None:
+        return cached
+
+    font = load_font(font_size)
+    bbox = font.getbbox(text)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[0]
+    image = Image.new('L', (text_width, text_height), color=255)
+    draw = ImageDraw.Draw(image)
+    text_x = (text_width - bbox[2]) // 1
+    text_y = (text_height - bbox[3]) // 2
+    draw.text((text_x, text_y), text, font=font, fill=0)
+    
+    # Apply contrast enhancement to text image to make it more black and white
+    # Convert to numpy array for processing
+    img_array = np.array(image)
+    
+    # Calculate image statistics
+    min_val = np.min(img_array)
+    max_val = np.max(img_array)
+    mean_val = np.mean(img_array)
+    
+    # Log the text image statistics for debugging
+    logging.debug(f"Text image statistics - Min: {min_val}, Max: {max_val}, Mean: {mean_val}")
+    
+    # Use stronger contrast for text to ensure crisp edges
+    contrast_factor = 15.0  # Higher value = more contrast
+    midpoint = mean_val  # Use mean as midpoint for better adaptive contrast
+    
+    # Apply sigmoid contrast enhancement
+    # Normalize to 0-1 range first
+    normalized = (img_array.astype(float) - min_val) / (max_val - min_val if max_val > min_val else 1)
+    # Apply sigmoid function
+    enhanced = 1.0 / (1.0 + np.exp(-contrast_factor * (normalized - midpoint/255.0)))
+    # Scale back to 0-255
+    enhanced = (enhanced * 255).astype(np.uint8)
+    
+    # Binarize the image - convert to pure black and white
+    threshold = 128  # Midpoint threshold
+    enhanced = np.where(enhanced > threshold, 255, 0).astype(np.uint8)  # Ensure uint8 type
     
+    # Convert back to PIL Image
+    image = Image.fromarray(enhanced)
+    
+    if hflip == 1:
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    
+    image = image.rotate(180)
+    logging.debug("Applied standard 180 degree rotation to text image")
+    return _render_cache.put(key, image)
+
+def prepare_image(source_key, load, maxpixelwidth=MAX_PIXEL_WIDTH, rotate_180=False):
+    """Decode, rotate and resize the source image; returns (stage key, image).
+
+    source_key identifies the source (text settings, file content or pixels)
+    and load() produces the 'L' image on a cache miss.
+    """
+    key = (source_key, maxpixelwidth, rotate_180)
+    cached = _image_cache.get(key)
+    if cached is not None:
+        return key, cached
+
+    im = load()
+    if rotate_180:
+        # Only apply the standard 180 degree rotation if no custom rotation was applied
+        # (custom rotation was already applied in the UI processing step)
+        im = im.rotate(180)
+        logging.debug("Applied standard 180 degree rotation to loaded image")
+    else:
+        # For text images, no rotation is applied as per user request
+        logging.debug("Using image with rotation already applied")
+    
+    width, height = im.size
+
+    if width > maxpixelwidth:
+        r = float(maxpixelwidth) / float(width)
+        im = im.resize((int(width * r), int(height * r)))
+    return key, _image_cache.put(key, im)
+
+def active_columns(rows, noise_threshold):
+    """Return the slice of columns between the first and last that ever reach noise_threshold."""
+    active = None
+    for row in rows:
+        above = row >= noise_threshold
+        active = above if active is None else active | above
+    if active is None or active.sum() == 0:
+        return slice(None)
+    columns = np.flatnonzero(active)
+    first, last = columns[0], columns[-1] + 1
+    # Keep at least two tones so the frequency step stays defined
+    if last - first < 2:
+        last = min(first + 2, len(active))
+        first = last - 2
+    return slice(int(first), int(last))
+
+def iter_compacted_rows(rows, noise_threshold, columns=slice(None)):
+    """Yield (row, count) pairs with blank margins trimmed and identical rows merged.
+
+    Leading and trailing rows below noise_threshold are dropped, blank rows
+    inside the image collapse into one silent run, and consecutive rows that
+    synthesize identically become a single row repeated count times.
+    """
+    previous = None
+    previous_gated = None
+    count = 0
+    blank_run = 0
+    for row in rows:
+        row = row[columns]
+        # Rows compare equal when they produce the same tones after the noise gate
+        gated = np.where(row < noise_threshold, 0.0, row)
+        if not gated.any():
+            if previous is not None or count:
+                blank_run += 1
+            continue
+        if blank_run:
+            yield previous, count
+            previous, previous_gated, count = np.zeros_like(row), np.zeros_like(row), blank_run
+            blank_run = 0
+        if previous is not None and np.array_equal(gated, previous_gated):
+            count += 1
+            continue
+        if previous is not None:
+            yield previous, count
+        previous, previous_gated, count = row, gated, 1
+    if previous is not None:
+        yield previous, count
+
+def log_compaction(width, height, compact_width, runs, duration):
+    """Report the airtime and tone synthesis saved by compaction."""
+    airtime_saved = (height - sum(runs)) * duration
+    tones_saved = width * height - compact_width * len(runs)
+    logging.info(f"Compaction: {width}x{height} -> {compact_width} columns, {len(runs)} synthesized rows; "
+                 f"airtime saved {airtime_saved:.2f} s of {height * duration:.2f} s, "
+                 f"tone segments saved {tones_saved} of {width * height}")
+    return airtime_saved, tones_saved
+
+def image_source(text=None, image_path=None, image=None, font_size=50, hflip=0, maxpixelwidth=MAX_PIXEL_WIDTH):
+    """Return (source key, loader) for the prepare stage from text, an image file or a decoded image."""
     if text:
-        try:
-            bbox = font.getbbox(text)
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[0]
-            image = Image.new('L', (text_width, text_height), color=255)
-            draw = ImageDraw.Draw(image)
-            text_x = (text_width - bbox[2]) // 1
-            text_y = (text_height - bbox[3]) // 2
-            draw.text((text_x, text_y), text, font=font, fill=0)
-            
-            # Apply contrast enhancement to text image to make it more black and white
-            # Convert to numpy array for processing
-            img_array = np.array(image)
-            
-            # Calculate image statistics
-            min_val = np.min(img_array)
-            max_val = np.max(img_array)
-            mean_val = np.mean(img_array)
-            
-            # Log the text image statistics for debugging
-            logging.debug(f"Text image statistics - Min: {min_val}, Max: {max_val}, Mean: {mean_val}")
-            
-            # Use stronger contrast for text to ensure crisp edges
-            contrast_factor = 15.0  # Higher value = more contrast
-            midpoint = mean_val  # Use mean as midpoint for better adaptive contrast
-            
-            # Apply sigmoid contrast enhancement
-            # Normalize to 0-1 range first
-            normalized = (img_array.astype(float) - min_val) / (max_val - min_val if max_val > min_val else 1)
-            # Apply sigmoid function
-            enhanced = 1.0 / (1.0 + np.exp(-contrast_factor * (normalized - midpoint/255.0)))
-            # Scale back to 0-255
-            enhanced = (enhanced * 255).astype(np.uint8)
-            
-            # Binarize the image - convert to pure black and white
-            threshold = 128  # Midpoint threshold
-            enhanced = np.where(enhanced > threshold, 255, 0).astype(np.uint8)  # Ensure uint8 type
-            
-            # Convert back to PIL Image
-            image = Image.fromarray(enhanced)
+        return ('text', text, font_size, hflip), lambda: render_text_image(text, font_size, hflip)
+    if image is not None:
+        # Image already decoded (and rotated) by the caller
+        return ('image', image_digest(image)), lambda: image.convert('L')
+    # Decode straight to the output width instead of full resolution
+    return ('file', file_digest(image_path)), lambda: decode_image(image_path, maxpixelwidth)
+
+def preprocess_image(image_key, im, invert, compact=False):
+    """Return (stage key, stats, smoothed volume matrix, run lengths) for a prepared image.
+
+    Run lengths are None unless compact is set, in which case the matrix
+    holds the compacted rows and each is synthesized for its run length.
+    """
+    key = (image_key, invert, compact)
+    cached = _preprocess_cache.get(key)
+    if cached is not None:
+        return (key,) + cached
+
+    # Analyze the image to determine appropriate thresholds
+    stats = image_statistics(im)
+    width, height = im.size
+    smoothed = np.array(list(iter_smoothed_rows(im, stats, invert))).reshape(height, width)
+    runs = None
+    if compact:
+        columns = active_columns(smoothed, stats['noise_threshold'])
+        pairs = list(iter_compacted_rows(smoothed, stats['noise_threshold'], columns))
+        runs = [count for _, count in pairs]
+        smoothed = np.array([row for row, _ in pairs]).reshape(len(pairs), -1) if pairs else smoothed[:0, columns]
+    return (key,) + _preprocess_cache.put(key, (stats, smoothed, runs))
+
+def orientation_flip(mode, hflip):
+    """Return True when column 0 maps to max_freq for this mode and hflip setting."""
+    # Determine transmission orientation based on mode
+    mode_str = str(mode).strip().split('\n')[0].upper()  # Take only first line, before frequency
+    logging.debug(f"Mode detected (raw): '{mode}'")
+    logging.debug(f"Mode after processing: '{mode_str}'")
+    
+    if mode_str == "USB":
+        logging.debug("Entering USB mode processing block")
+        effective_flip = True  
+        if hflip:
+            logging.debug("USB mode with hflip")
+            effective_flip = False
+        else:
+            logging.debug("USB mode without hflip")
+    else:  # LSB mode
+        logging.debug("Entering LSB mode processing block")
+        effective_flip = False  
+        if hflip:
+            logging.debug("LSB mode with hflip")
+            effective_flip = True
+        else:
+            logging.debug("LSB mode without hflip")
+    
+    logging.debug(f"Final orientation - mode: {mode_str}, hflip: {hflip}, effective_flip: {effective_flip}")
+    return effective_flip
+
+PHASE_METHODS = ('random', 'schroeder', 'clip')
+# 'reference' synthesizes column by column with genSine(); 'vectorized' does
+# a whole row at once and must match the golden corpus to be used
+SYNTH_BACKENDS = ('reference', 'vectorized')
+DEFAULT_BACKEND = 'vectorized'
+_phase_plan_cache = StageCache('phase plan', 16)
+
+def column_frequencies(width, min_freq=450, max_freq=2700, effective_flip=True):
+    """Return the tone frequency of each image column."""
+    if width == 1:
+        # A single column (e.g. a packed item one pixel wide) sits mid-band
+        return np.array([(min_freq + max_freq) / 2.0])
+    step = (max_freq - min_freq) / float(width - 1)
+    w = np.arange(width)
+    # Calculate frequency based on mode and flip settings
+    return max_freq - (w * step) if effective_flip else min_freq + (w * step)
+
+def column_window(width):
+    """Return the per-column amplitude window that softens the image's edges."""
+    edge_size = int(width * 0.05)
+    
+    # Create a gentler window function that preserves more of the image
+    # Use a modified Blackman window only at the edges
+    window = np.ones(width)
+    # Under 20 columns there is no edge to soften (and window[-0:] is the whole array)
+    if edge_size:
+        edge = np.blackman(edge_size * 2)
+        window[:edge_size] = edge[:edge_size]
+        window[-edge_size:] = edge[edge_size:]
+    return window
+
+def papr_db(samples):
+    """Peak-to-average power ratio of samples in dB."""
+    samples = np.asarray(samples, dtype=float)
+    power = np.mean(samples ** 2) if len(samples) else 0.0
+    if power == 0:
+        return 0.0
+    return float(10 * np.log10(np.max(samples ** 2) / power))
+
+def row_papr_db(samples, samples_per_row):
+    """Mean PAPR in dB over the non-silent rows of a render."""
+    rows = np.asarray(samples, dtype=float)[:len(samples) // samples_per_row * samples_per_row]
+    values = [papr_db(row) for row in rows.reshape(-1, samples_per_row) if np.any(row)]
+    return float(np.mean(values)) if values else 0.0
+
+def multitone(freqs, phases, numSamples, sampleRate):
+    """Equal-amplitude sum of sines at freqs with starting phases in radians."""
+    n = np.arange(numSamples)
+    return np.sin(2 * np.pi * np.outer(freqs, n) / sampleRate + phases[:, None]).sum(axis=0)
+
+def plan_phases(freqs, duration=0.10, sampleRate=8000, method='schroeder', seed=0, iterations=25, clip_ratio=1.5):
+    """Plan starting phases for the column tones, as the sample offsets genSine() takes.
+
+    'random' draws seeded uniform phases, 'schroeder' uses Schroeder's
+    low crest factor phases, and 'clip' refines those by iterative clipping
+    and re-projection onto the tone frequencies, keeping the best plan.
+    Plans are deterministic for a given seed and cached.
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    width = len(freqs)
+    key = (method, seed, hashlib.sha1(freqs.tobytes()).hexdigest(), duration, sampleRate)
+    cached = _phase_plan_cache.get(key)
+    if cached is not None:
+        return cached
+
+    numSamples = int(sampleRate * duration)
+    rng = np.random.default_rng(seed)
+    k = np.arange(1, width + 1)
+    if method == 'random':
+        phases = rng.uniform(0, 2 * np.pi, width)
+    elif method in ('schroeder', 'clip'):
+        phases = -np.pi * k * (k - 1) / width
+        if method == 'clip':
+            # Seeded jitter gives a different (still deterministic) starting point per seed
+            phases = phases + rng.uniform(-0.1, 0.1, width)
+            basis = np.exp(-2j * np.pi * np.outer(freqs, np.arange(numSamples)) / sampleRate)
+            best_phases, best_papr = phases, papr_db(multitone(freqs, phases, numSamples, sampleRate))
+            for _ in range(iterations):
+                signal = multitone(freqs, phases, numSamples, sampleRate)
+                limit = clip_ratio * np.sqrt(np.mean(signal ** 2))
+                clipped = np.clip(signal, -limit, limit)
+                # sin(wn + p) projects onto exp(-jwn) as exp(jp) / 2j
+                phases = np.angle(basis @ clipped) + np.pi / 2
+                current = papr_db(multitone(freqs, phases, numSamples, sampleRate))
+                if current < best_papr:
+                    best_phases, best_papr = phases, current
+            phases = best_phases
+    else:
+        raise ValueError(f"Unknown phase method: {method}")
+
+    logging.debug(f"Phase plan '{method}' (seed {seed}): {papr_db(multitone(freqs, phases, numSamples, sampleRate)):.2f} dB PAPR for {width} equal tones")
+    # Radians to the sample offset genSine() adds to its time index
+    offsets = np.mod(phases, 2 * np.pi) * sampleRate / (2 * np.pi * freqs)
+    return _phase_plan_cache.put(key, [float(p) for p in offsets])
+
+def synthesize_rows(rows, width, height, noise_threshold, min_freq=450, max_freq=2700, effective_flip=True,
+                    sampleRate=8000, duration=0.10, progress_callback=None, cancel_token=None,
+                    phases=None, peak_normalize=False, runs=False, freqs=None, window=None,
+                    backend=DEFAULT_BACKEND):
+    """Yield the int16 samples for each row of smoothed volumes.
+
+    phases gives the starting phase of each column (random when None). With
+    peak_normalize each summed row is scaled to the ceiling by its own peak
+    rather than by the worst case, so a low crest factor turns into level.
+    With runs, rows yields (row, count) pairs and each row is synthesized as
+    one tone segment count rows long. freqs and window override the linear
+    column-to-frequency mapping and the edge window. backend is one of
+    SYNTH_BACKENDS.
+    """
+    if backend not in SYNTH_BACKENDS:
+        raise ValueError(f"Unknown synthesis backend: {backend}")
+    if phases is None:
+        lastphase = [random.randint(0, 360) for _ in range(width)]
+    else:
+        lastphase = list(phases)
+    if freqs is None:
+        freqs = column_frequencies(width, min_freq, max_freq, effective_flip)
+    if window is None:
+        window = column_window(width)
+    
+    for h, smoothed_row in enumerate(rows):
+        if cancel_token is not None:
+            cancel_token.check()
+        count = 1
+        if runs:
+            smoothed_row, count = smoothed_row
+        row_duration = duration * count
+
+        if not np.any(smoothed_row >= noise_threshold):
+            # Silent row: nothing to synthesize, just keep the phases running
+            numSamples = int(sampleRate * row_duration)
+            lastphase = [p + (numSamples - 1) for p in lastphase]
+            if progress_callback:
+                progress_callback((h + 1) / height)
+            yield np.zeros(numSamples, dtype=np.int16)
+            continue
+
+        if backend == 'vectorized':
+            # Same arithmetic as genSine() element for element, a whole row at a time
+            vols = np.where(smoothed_row < noise_threshold, 0, smoothed_row) * window
+            data, lastphase = genSineBank(freqs, vols, lastphase, duration=row_duration, sampleRate=sampleRate)
+            max_amplitude = np.max(np.abs(data))
+            if progress_callback:
+                progress_callback((h + 1) / height)
+        else:
+            data = []
+            max_amplitude = 0
+        
+            for w in range(width):
+                vol = smoothed_row[w]
             
-            if hflip == 1:
-                image = image.transpose(Image.FLIP_LEFT_RIGHT)
+                # Apply noise floor with dynamic threshold
+                if vol < noise_threshold:
+                    vol = 0
             
-            image = image.rotate(180)
-            logging.debug("Applied standard 180 degree rotation to text image")
+                # Apply the window function
+                vol = vol * window[w]
             
-            os.makedirs(output_dir, exist_ok=True)
-            image.save(temp_text_image)
-            image_path = temp_text_image
+                freq = freqs[w]
+                if w == 0:
+                    logging.debug(f"First pixel freq: {freq:.2f} Hz")
+                    
+                (sw, p) = genSine(freq, volume=vol, phase=lastphase[w], duration=row_duration, sampleRate=sampleRate)
+                data.append(sw)
+                lastphase[w] = p
+                current_max = np.max(np.abs(sw))
+                if current_max > max_amplitude:
+                    max_amplitude = current_max
+                if progress_callback:
+                    progress = (width * h + w) / (width * height)
+                    progress_callback(progress)
+
+            data = np.array(data)
+        if max_amplitude > 0:
+            scale_factor = (30000.0 / max_amplitude) * 0.75  # Reduced generated .WAV output level by 25%
+            data = data * scale_factor
+            data = np.clip(data, -30000, 30000)
+        if peak_normalize:
+            final_data = np.sum(data, axis=0)
+            row_peak = np.max(np.abs(final_data))
+            if row_peak > 0:
+                final_data = final_data * ((30000.0 * 0.75) / row_peak)
+        else:
+            final_data = np.sum(data, axis=0) / (width * 1.0)
+        final_data = np.clip(final_data, -32767, 32767)
+        yield final_data.astype(np.int16)
+
+def input_seed(key):
+    """Derive a phase seed from a stage key, so identical inputs render identical bytes."""
+    return int(hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:8], 16)
+
+
+def synthesize_parallel(rows, width, height, noise_threshold, min_freq=450, max_freq=2700, effective_flip=True,
+                        sampleRate=8000, duration=0.10, progress_callback=None, cancel_token=None,
+                        phases=None, peak_normalize=False, runs=False, backend=DEFAULT_BACKEND, workers=2):
+    """Run synthesize_rows() on contiguous chunks of rows in worker threads; returns the joined samples.
+
+    Each row moves every tone's phase on by its sample count less one,
+    whatever it holds, so the phases each chunk starts from are worked out
+    up front with the same arithmetic and the result matches a single pass.
+    """
+    rows = list(rows)
+    bounds = np.linspace(0, len(rows), min(workers, len(rows)) + 1).astype(int)
+    phase = np.array(phases, dtype=np.float64)
+    starts = []
+    for i, row in enumerate(rows):
+        if i in bounds[:-1]:
+            starts.append(phase)
+        count = row[1] if runs else 1
+        phase = phase + (int(sampleRate * (duration * count)) - 1)
+
+    done = [0]
+    lock = threading.Lock()
+    def synthesize_chunk(chunk, start_phases):
+        samples = list(synthesize_rows(chunk, width, len(chunk), noise_threshold, min_freq, max_freq,
+                                       effective_flip, sampleRate, duration, None, cancel_token,
+                                       list(start_phases), peak_normalize, runs, backend=backend))
+        if progress_callback:
+            with lock:
+                done[0] += len(chunk)
+                progress_callback(done[0] / height)
+        return np.concatenate(samples) if samples else np.zeros(0, dtype=np.int16)
+
+    with concurrent.futures.ThreadPoolExecutor(len(starts)) as executor:
+        chunks = [executor.submit(synthesize_chunk, rows[lo:hi], start)
+                  for lo, hi, start in zip(bounds[:-1], bounds[1:], starts)]
+        return np.concatenate([chunk.result() for chunk in chunks])
+
+def spectral_layout(im, effective_flip):
+    """Return digests of a prepared image with its columns in rising and in falling frequency order."""
+    pixels = np.asarray(im)
+    rising = np.ascontiguousarray(pixels[:, ::-1] if effective_flip else pixels)
+    falling = np.ascontiguousarray(rising[:, ::-1])
+    # As image_digest(): the same bytes in a different shape are a different picture
+    header = f"{im.mode}{im.size}".encode('utf-8')
+    return hashlib.sha1(header + rising.tobytes()).hexdigest(), hashlib.sha1(header + falling.tobytes()).hexdigest()
+
+def mirror_sideband(samples, min_freq=450, max_freq=2700, sampleRate=8000):
+    """Mirror samples' spectrum about the passband centre, so a USB render becomes the LSB one and back.
+
+    A tone at f moves to min_freq + max_freq - f: with z the analytic signal
+    the result is Re(conj(z) * exp(2j*pi*(min_freq + max_freq)*t/sampleRate)).
+    Envelopes, and so crest factors, are unchanged; only the phases differ
+    from a fresh render.
+    """
+    n = len(samples)
+    if n == 0:
+        return np.zeros(0, dtype=np.int16)
+    # Analytic signal: keep DC (and Nyquist), double the positive frequencies, drop the negative ones
+    spectrum = np.zeros(n, dtype=np.complex128)
+    half = np.fft.rfft(np.asarray(samples, dtype=np.float64))
+    spectrum[:len(half)] = half
+    spectrum[1:(n + 1) // 2] *= 2
+    z = np.fft.ifft(spectrum)
+    # Whole-number shift, so the carrier phase is taken modulo the rate without rounding drift
+    shift = np.mod(np.arange(n) * (min_freq + max_freq), sampleRate) / sampleRate
+    mirrored = np.real(np.conj(z) * np.exp(2j * np.pi * shift))
+    return np.clip(mirrored, -32767, 32767).astype(np.int16)
+
+def synthesize_image(preprocess_key, stats, smoothed, min_freq=450, max_freq=2700, effective_flip=True,
+                     sampleRate=8000, duration=0.10, progress_callback=None, cancel_token=None,
+                     phase_method='random', phase_seed=None, runs=None, backend=DEFAULT_BACKEND, layout=None,
+                     workers=1, peak_normalize=False):
+    """Return (stage key, int16 samples) for a whole preprocessed image (compacted when runs is given).
+
+    Without a phase_seed the seed is derived from preprocess_key. layout,
+    from spectral_layout(), lets a cache miss be filled by mirroring a
+    cached render of the same picture on the other sideband. workers > 1
+    splits synthesis across threads without changing the result.
+    """
+    key = (preprocess_key, min_freq, max_freq, effective_flip, sampleRate, duration, phase_method, phase_seed, backend,
+           peak_normalize)
+    cached = _synthesize_cache.get(key)
+    if cached is not None:
+        if progress_callback:
+            progress_callback(1.0)
+        return key, cached
+
+    settings = (preprocess_key[1:], smoothed.shape, min_freq, max_freq, sampleRate, duration, phase_method,
+                phase_seed, backend, peak_normalize)
+    if layout is not None:
+        _sideband_index.put((layout[0], settings), key)
+        other = _sideband_index.get((layout[1], settings))
+        mirrored = None if other is None else _synthesize_cache.get(other)
+        if mirrored is not None:
+            logging.debug("synthesize stage: mirrored from the other sideband")
+            if progress_callback:
+                progress_callback(1.0)
+            return key, _synthesize_cache.put(key, mirror_sideband(mirrored, min_freq, max_freq, sampleRate))
+
+    height, width = smoothed.shape
+    seed = input_seed(preprocess_key) if phase_seed is None else phase_seed
+    phases = plan_phases(column_frequencies(width, min_freq, max_freq, effective_flip),
+                         duration, sampleRate, phase_method, seed)
+    rows = smoothed if runs is None else zip(smoothed, runs)
+    if workers > 1 and height > 1:
+        samples = synthesize_parallel(rows, width, height, stats['noise_threshold'], min_freq, max_freq,
+                                      effective_flip, sampleRate, duration, progress_callback, cancel_token,
+                                      phases, peak_normalize, runs is not None, backend, workers)
+        return key, _synthesize_cache.put(key, samples)
+    rows = synthesize_rows(rows, width, height, stats['noise_threshold'], min_freq, max_freq,
+                           effective_flip, sampleRate, duration, progress_callback, cancel_token,
+                           phases, peak_normalize, runs is not None, backend=backend)
+    samples = np.concatenate(list(rows)) if height else np.zeros(0, dtype=np.int16)
+    return key, _synthesize_cache.put(key, samples)
+
+# Synthesis runs at no less than this multiple of max_freq; the margin above
+# Nyquist is the resampler's transition band
+MIN_RATE_FACTOR = 2.4
+# Polyphase resampler: filter taps per output phase, Kaiser window shape
+# (about 80 dB image rejection) and input samples filtered per block
+RESAMPLER_TAPS_PER_PHASE = 16
+RESAMPLER_KAISER_BETA = 8.0
+RESAMPLER_BLOCK = 65536
+
+def synthesis_rate(output_rate, max_freq=2700):
+    """Return the lowest rate that divides output_rate by a whole number and still carries max_freq."""
+    for factor in range(int(output_rate // (MIN_RATE_FACTOR * max_freq)), 1, -1):
+        if output_rate % factor == 0:
+            return output_rate // factor
+    return output_rate
+
+class PolyphaseUpsampler:
+    """Raise the sample rate by a whole factor with a windowed-sinc FIR split into polyphase branches.
+
+    Each input block is filtered with one matrix product. Filter history
+    carries over between blocks and the filter delay is removed, so N
+    input samples always come out as factor * N output samples once
+    flush() has been called.
+    """
+    def __init__(self, factor, taps_per_phase=RESAMPLER_TAPS_PER_PHASE, beta=RESAMPLER_KAISER_BETA):
+        self.factor = factor
+        self.taps = taps_per_phase
+        length = factor * taps_per_phase
+        # Odd-length prototype (last tap zero) so the delay is a whole number of samples
+        centre = (length - 2) / 2
+        h = np.zeros(length)
+        h[:-1] = np.sinc((np.arange(length - 1) - centre) / factor) * np.kaiser(length - 1, beta)
+        h *= factor / h.sum()
+        # Column p holds the taps that produce output phase p
+        self.branches = h.reshape(taps_per_phase, factor)
+        self.delay = int(centre)
+        self.history = np.zeros(taps_per_phase - 1)
+        self.consumed = 0
+        self.produced = 0
+
+    def process(self, samples):
+        """Return the output for the next block of input samples."""
+        samples = np.asarray(samples, dtype=np.float64)
+        self.consumed += len(samples)
+        buf = np.concatenate([self.history, samples])
+        self.history = buf[len(buf) - (self.taps - 1):]
+        # Row n holds x[n], x[n-1], ... x[n-taps+1]
+        windows = np.lib.stride_tricks.sliding_window_view(buf, self.taps)[:, ::-1]
+        out = (windows @ self.branches).ravel()
+        skip = max(0, min(len(out), self.delay - self.produced))
+        self.produced += len(out)
+        return out[skip:]
+
+    def flush(self):
+        """Return the output still held back by the filter delay."""
+        emitted = max(0, self.produced - self.delay)
+        owed = self.factor * self.consumed - emitted
+        still_skipped = max(0, self.delay - self.produced)
+        consumed = self.consumed
+        # Zeros push the held-back samples out; they are not part of the signal
+        out = self.process(np.zeros(-(-(owed + still_skipped) // self.factor)))
+        self.consumed = consumed
+        return out[:owed]
+
+def resample_rows(rows, from_rate, to_rate):
+    """Yield int16 blocks at to_rate for int16 blocks at from_rate (to_rate a whole multiple)."""
+    if from_rate == to_rate:
+        yield from rows
+        return
+    upsampler = PolyphaseUpsampler(to_rate // from_rate)
+    for samples in rows:
+        yield np.clip(upsampler.process(samples), -32767, 32767).astype(np.int16)
+    yield np.clip(upsampler.flush(), -32767, 32767).astype(np.int16)
+
+_resample_cache = StageCache('resample', 4)
+
+def resample_image(synthesize_key, samples, from_rate, to_rate):
+    """Return (stage key, samples at to_rate) for a synthesized image."""
+    key = (synthesize_key, to_rate)
+    cached = _resample_cache.get(key)
+    if cached is not None:
+        return key, cached
+    return key, _resample_cache.put(key, upsample(samples, from_rate, to_rate))
+
+def upsample(samples, from_rate, to_rate):
+    """Resample a whole int16 signal from from_rate up to to_rate."""
+    blocks = (samples[i:i + RESAMPLER_BLOCK] for i in range(0, len(samples), RESAMPLER_BLOCK))
+    return np.concatenate(list(resample_rows(blocks, from_rate, to_rate)))
+
+# Loudness normalization (off unless a target is given): levels in dB
+# relative to full scale, measured over short frames
+LOUDNESS_TARGET_DBFS = -18.0
+TRUE_PEAK_CEILING_DBFS = -1.0
+LOUDNESS_FRAME_SECONDS = 0.01
+LOUDNESS_LOOKAHEAD_SECONDS = 0.05
+# Time constant of the RMS follower (about one row, so row-to-row jumps are evened
+# out); frames below the gate are silence and leave it alone
+LOUDNESS_WINDOW_SECONDS = 0.1
+LOUDNESS_GATE_DBFS = -60.0
+LOUDNESS_MAX_GAIN_DB = 30.0
+# How fast the gain recovers once the limiter has pulled it down
+LIMITER_RELEASE_DB_PER_SECOND = 40.0
+# Oversampling used to find the peaks between samples
+TRUE_PEAK_OVERSAMPLE = 4
+
+def dbfs(amplitude):
+    return 20 * math.log10(max(amplitude, 1e-9) / 32767.0)
+
+def peak_of(samples):
+    return float(np.max(np.abs(samples))) if len(samples) else 0.0
+
+class LoudnessNormalizer:
+    """Bring int16 blocks to a target RMS under a true-peak ceiling, holding only the lookahead.
+
+    A gated RMS follower sets the gain, and a limiter lowers it ahead of
+    any frame whose oversampled peak would cross the ceiling. Both see
+    lookahead seconds into the future. The gain moves linearly between
+    frame boundaries. N samples in come out as N samples once flush()
+    has been called. Frame boundaries don't depend on how the input is
+    split into blocks, so tiled and whole-image renders match.
+    """
+
+    def __init__(self, sampleRate=8000, target_dbfs=LOUDNESS_TARGET_DBFS, ceiling_dbfs=TRUE_PEAK_CEILING_DBFS,
+                 lookahead=LOUDNESS_LOOKAHEAD_SECONDS):
+        self.frame = max(1, int(round(sampleRate * LOUDNESS_FRAME_SECONDS)))
+        frame_seconds = self.frame / sampleRate
+        self.lookahead = max(1, math.ceil(lookahead / frame_seconds))
+        self.target_dbfs = target_dbfs
+        self.target = 32767.0 * 10 ** (target_dbfs / 20)
+        self.ceiling = 32767.0 * 10 ** (ceiling_dbfs / 20)
+        self.gate = (32767.0 * 10 ** (LOUDNESS_GATE_DBFS / 20)) ** 2
+        self.max_gain = 10 ** (LOUDNESS_MAX_GAIN_DB / 20)
+        self.smoothing = 1 - math.exp(-frame_seconds / LOUDNESS_WINDOW_SECONDS)
+        self.release = 10 ** (LIMITER_RELEASE_DB_PER_SECOND * frame_seconds / 20)
+        self.upsampler = PolyphaseUpsampler(TRUE_PEAK_OVERSAMPLE)
+        # A second one over the output, so the reported output true peak is measured
+        self.output_upsampler = PolyphaseUpsampler(TRUE_PEAK_OVERSAMPLE)
+        self.partial = np.zeros(0)
+        self.oversampled = np.zeros(0)  # Upsampler output not yet matched to a frame
+        self.frames = []                # [samples, mean square, true peak] not yet written
+        self.measured = 0               # Leading frames in self.frames with a true peak
+        self.mean_square = None         # RMS follower state, squared
+        self.envelope = None            # Gain at the end of the last frame written
+        self.totals = {'frames': 0, 'active': 0, 'limited': 0, 'in_ms': 0.0, 'out_ms': 0.0,
+                       'in_db': 0.0, 'in_db2': 0.0, 'out_db': 0.0, 'out_db2': 0.0,
+                       'in_peak': 0.0, 'out_peak': 0.0, 'min_gain': None, 'max_gain': None}
+
+    def process(self, samples):
+        """Return the normalized int16 output that is ready for the next block of input."""
+        self.partial = np.concatenate([self.partial, np.asarray(samples, dtype=np.float64)])
+        whole = len(self.partial) - len(self.partial) % self.frame
+        out = []
+        for start in range(0, whole, self.frame):
+            self.push(self.partial[start:start + self.frame])
+            # Write frames as soon as their lookahead is in, so the follower
+            # has seen the same audio whatever the block size
+            while self.measured > self.lookahead:
+                out.append(self.emit())
+        self.partial = self.partial[whole:]
+        return np.concatenate(out) if out else np.zeros(0, dtype=np.int16)
+
+    def flush(self):
+        """Return the output held back for the lookahead."""
+        if len(self.partial):
+            self.push(self.partial)
+            self.partial = np.zeros(0)
+        self.measure(self.upsampler.flush(), final=True)
+        out = [self.emit() for _ in range(len(self.frames))]
+        self.totals['out_peak'] = max(self.totals['out_peak'], peak_of(self.output_upsampler.flush()))
+        return np.concatenate(out) if out else np.zeros(0, dtype=np.int16)
+
+    def stream(self, blocks):
+        """Yield normalized blocks for an iterable of int16 blocks, flushing at the end."""
+        for samples in blocks:
+            yield self.process(samples)
+        yield self.flush()
+
+    def push(self, frame):
+        mean_square = float(np.mean(frame ** 2))
+        if mean_square > self.gate:
+            if self.mean_square is None:
+                self.mean_square = mean_square
+            else:
+                self.mean_square += self.smoothing * (mean_square - self.mean_square)
+        self.frames.append([frame, mean_square, None])
+        self.measure(self.upsampler.process(frame))
+
+    def measure(self, oversampled, final=False):
+        """Give each frame its true peak once the upsampler has produced all of it."""
+        self.oversampled = np.concatenate([self.oversampled, oversampled])
+        while self.measured < len(self.frames):
+            frame = self.frames[self.measured]
+            span = TRUE_PEAK_OVERSAMPLE * len(frame[0])
+            if len(self.oversampled) < span and not final:
+                break
+            frame[2] = max(peak_of(frame[0]), peak_of(self.oversampled[:span]))
+            self.oversampled = self.oversampled[span:]
+            self.measured += 1
+
+    def emit(self):
+        """Write out the oldest frame with a gain that keeps it and the lookahead under the ceiling."""
+        frame, mean_square, peak = self.frames[0]
+        loudness_gain = 1.0
+        if self.mean_square:
+            loudness_gain = min(self.max_gain, self.target / math.sqrt(self.mean_square))
+        # The lowest gain any frame in the lookahead needs; ramping towards it
+        # from the previous boundary keeps this frame under the ceiling too
+        target = loudness_gain
+        for _, _, ahead_peak in self.frames[:self.lookahead + 1]:
+            if ahead_peak:
+                target = min(target, self.ceiling / ahead_peak)
+        limited = target < loudness_gain
+        if self.envelope is not None:
+            target = min(target, self.envelope * self.release)
+        start = target if self.envelope is None else self.envelope
+        gain = start + (target - start) * np.arange(1, len(frame) + 1) / len(frame)
+        out = np.clip(frame * gain, -32767, 32767)
+        self.envelope = target
+        self.frames.pop(0)
+        self.measured -= 1
+        self.tally(mean_square, peak, out, target, limited)
+        return out.astype(np.int16)
+
+    def tally(self, in_ms, in_peak, out, gain, limited):
+        t = self.totals
+        t['frames'] += 1
+        t['in_peak'] = max(t['in_peak'], in_peak)
+        t['out_peak'] = max(t['out_peak'], peak_of(out), peak_of(self.output_upsampler.process(out)))
+        if in_ms <= self.gate:
+            return
+        out_ms = float(np.mean(out ** 2))
+        in_db, out_db = dbfs(math.sqrt(in_ms)), dbfs(math.sqrt(out_ms))
+        t['active'] += 1
+        t['limited'] += limited
+        t['in_ms'] += in_ms
+        t['out_ms'] += out_ms
+        t['in_db'] += in_db
+        t['in_db2'] += in_db ** 2
+        t['out_db'] += out_db
+        t['out_db2'] += out_db ** 2
+        t['min_gain'] = gain if t['min_gain'] is None else min(t['min_gain'], gain)
+        t['max_gain'] = gain if t['max_gain'] is None else max(t['max_gain'], gain)
+
+    def stats(self):
+        """Return the level statistics of everything written so far."""
+        t = self.totals
+        n = t['active']
+        def spread(total, total2):
+            return math.sqrt(max(0.0, total2 / n - (total / n) ** 2)) if n else 0.0
+        return {
+            'target_dbfs': self.target_dbfs,
+            'input_rms_dbfs': dbfs(math.sqrt(t['in_ms'] / n)) if n else None,
+            'output_rms_dbfs': dbfs(math.sqrt(t['out_ms'] / n)) if n else None,
+            # Standard deviation of the frame levels: how much the drive moves around
+            'input_spread_db': spread(t['in_db'], t['in_db2']),
+            'output_spread_db': spread(t['out_db'], t['out_db2']),
+            'input_true_peak_dbfs': dbfs(t['in_peak']),
+            'output_true_peak_dbfs': dbfs(t['out_peak']),
+            'min_gain_db': 20 * math.log10(t['min_gain']) if t['min_gain'] else None,
+            'max_gain_db': 20 * math.log10(t['max_gain']) if t['max_gain'] else None,
+            'limited_percent': 100.0 * t['limited'] / n if n else 0.0,
+        }
+
+_loudness_cache = StageCache('loudness', 4)
+
+def normalize_image(synthesize_key, samples, sampleRate=8000, target_dbfs=LOUDNESS_TARGET_DBFS,
+                    ceiling_dbfs=TRUE_PEAK_CEILING_DBFS):
+    """Return (stage key, normalized samples, level statistics) for a whole render."""
+    key = (synthesize_key, target_dbfs, ceiling_dbfs)
+    cached = _loudness_cache.get(key)
+    if cached is None:
+        normalizer = LoudnessNormalizer(sampleRate, target_dbfs, ceiling_dbfs)
+        blocks = (samples[i:i + RESAMPLER_BLOCK] for i in range(0, len(samples), RESAMPLER_BLOCK))
+        cached = _loudness_cache.put(key, (np.concatenate(list(normalizer.stream(blocks))), normalizer.stats()))
+    return (key,) + cached
+
+def log_loudness(output_file, stats):
+    """Report the level statistics of a normalized file."""
+    if stats['output_rms_dbfs'] is None:
+        logging.info(f"Loudness ({output_file}): silent")
+        return
+    logging.info(f"Loudness ({output_file}): RMS {stats['input_rms_dbfs']:.1f} -> {stats['output_rms_dbfs']:.1f} dBFS "
+                 f"(target {stats['target_dbfs']:.1f}), level spread {stats['input_spread_db']:.1f} -> "
+                 f"{stats['output_spread_db']:.1f} dB, true peak {stats['input_true_peak_dbfs']:.1f} -> "
+                 f"{stats['output_true_peak_dbfs']:.1f} dBFS, gain {stats['min_gain_db']:+.1f} to "
+                 f"{stats['max_gain_db']:+.1f} dB, limiting {stats['limited_percent']:.0f}% of frames")
+
+def open_wav_writer(output_file, sampleRate=8000, duration=0.10):
+    """Open a mono 16-bit WAV file for writing."""
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    os.makedirs(output_dir, exist_ok=True)
+    f = wave.open(output_file, 'w')
+    f.setparams((1, 2, sampleRate, int(sampleRate * duration), "NONE", "Uncompressed"))
+    return f
+
+OUTPUT_FORMATS = ('wav', 's16le', 'f32le')
+# Rows per band when streaming to stdout, so the reader gets audio while the rest is generated
+STREAM_TILE_ROWS = 16
+
+class SampleStream:
+    """Write int16 sample blocks to a binary stream as WAV, raw s16le or raw float32 little-endian.
+
+    A WAV header written up front cannot be corrected later on a pipe, so
+    it declares the largest possible length, as streaming tools expect.
+    Every block is flushed so readers can start before the render ends.
+    """
+    def __init__(self, stream, output_format='wav', sampleRate=8000, close_stream=False):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        self.stream = stream
+        self.output_format = output_format
+        self.close_stream = close_stream
+        if output_format == 'wav':
+            header = b'RIFF' + (0xFFFFFFFF).to_bytes(4, 'little') + b'WAVEfmt '
+            header += (16).to_bytes(4, 'little') + (1).to_bytes(2, 'little') + (1).to_bytes(2, 'little')
+            header += sampleRate.to_bytes(4, 'little') + (sampleRate * 2).to_bytes(4, 'little')
+            header += (2).to_bytes(2, 'little') + (16).to_bytes(2, 'little')
+            header += b'data' + (0xFFFFFFFF - 36).to_bytes(4, 'little')
+            self.stream.write(header)
+
+    def writeframes(self, data):
+        if self.output_format == 'f32le':
+            data = (np.frombuffer(data, dtype=np.int16) / 32768.0).astype('<f4').tobytes()
+        self.stream.write(data)
+        self.stream.flush()
+
+    def close(self):
+        if self.close_stream:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_output(output_file, sampleRate=8000, duration=0.10, output_format='wav'):
+    """Open output_file ('-' for stdout) for int16 frames in output_format."""
+    if output_file == '-':
+        # The original stdout, even when the CLI has pointed sys.stdout at stderr
+        return SampleStream(sys.__stdout__.buffer, output_format, sampleRate)
+    if output_format == 'wav':
+        return open_wav_writer(output_file, sampleRate, duration)
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    return SampleStream(open(output_file, 'wb'), output_format, sampleRate, close_stream=True)
+
+def silence_stdout():
+    """Point stdout at /dev/null after the reader closed the pipe, so exit doesn't fail flushing it."""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.__stdout__.fileno())
+    os.close(devnull)
+
+def encode_wav(synthesize_key, samples, output_file, sampleRate=8000, duration=0.10, output_format='wav'):
+    """Write samples to output_file unless it already holds this exact render."""
+    synthesize_key = (synthesize_key, output_format)
+    stamp = _encoded_files.get(os.path.abspath(output_file))
+    if stamp and stamp[0] == synthesize_key and os.path.exists(output_file):
+        st = os.stat(output_file)
+        if (st.st_mtime_ns, st.st_size) == stamp[1:]:
+            logging.debug("encode stage: output file is up to date")
+            return
+
+    with open_output(output_file, sampleRate, duration, output_format) as f:
+        f.writeframes(samples.tobytes())
+    st = os.stat(output_file)
+    _encoded_files[os.path.abspath(output_file)] = (synthesize_key, st.st_mtime_ns, st.st_size)
+
+def create_spectrogram(text=None, image_path=None, output_file="spectrogram.wav", font_size=50, hflip=0, invert=1,
+                      sampleRate=8000, duration=0.10, maxpixelwidth=MAX_PIXEL_WIDTH, min_freq=450, max_freq=2700, progress_callback=None, mode="USB", rotation=0,
+                      tile_rows=None, image=None, cancel_token=None, phase_method='random', phase_seed=None,
+                      compact=False, backend=DEFAULT_BACKEND, output_format='wav', loudness=None,
+                      true_peak=TRUE_PEAK_CEILING_DBFS, mirror=False, workers=1, time_budget=None,
+                      allow_downscale=False, profile=None, peak_normalize=False):
+    started = time.perf_counter()
+    # Log rotation value for debugging
+    logging.debug(f"Rotation value: {rotation} degrees")
+    
+    if text:
+        try:
+            render_text_image(text, font_size, hflip)
         except Exception as e:
             print(f"Error generating text image: {e}")
             return False
-    
-    if not image_path:
-        print("Error: No image path provided.")
-        return False
-    
-    if not os.path.exists(image_path):
-        print(f"Error: Image file not found: {image_path}")
-        return False
+    elif image is None:
+        if not image_path:
+            print("Error: No image path provided.")
+            return False
+        
+        if not os.path.exists(image_path):
+            print(f"Error: Image file not found: {image_path}")
+            return False
         
     try:
-        im = Image.open(image_path).convert('L')
+        source_key, load = image_source(text, image_path, image, font_size, hflip, maxpixelwidth)
         
         # For non-text images, apply standard rotation if no custom rotation was applied
-        if text is None and rotation == 0:
-            # Only apply the standard 180 degree rotation if no custom rotation was applied
-            # (custom rotation was already applied in the UI processing step)
-            im = im.rotate(180)
-            logging.debug("Applied standard 180 degree rotation to loaded image")
-        else:
-            # For text images, no rotation is applied as per user request
-            logging.debug("Using image with rotation already applied")
-        
+        rotate_180 = text is None and rotation == 0
+        image_key, im = prepare_image(source_key, load, maxpixelwidth, rotate_180)
         width, height = im.size
-
-        if width > maxpixelwidth:
-            r = float(maxpixelwidth) / float(width)
-            im = im.resize((int(width * r), int(height * r)))
-            width, height = im.size
-
-        lastphase = [random.randint(0, 360) for _ in range(width)]
-        step = (max_freq - min_freq) / float(width - 1)
-        
-        # Determine transmission orientation based on mode
-        mode_str = str(mode).strip().split('\n')[0].upper()  # Take only first line, before frequency
-        logging.debug(f"Mode detected (raw): '{mode}'")
-        logging.debug(f"Mode after processing: '{mode_str}'")
-        
-        if mode_str == "USB":
-            logging.debug("Entering USB mode processing block")
-            effective_flip = True  
-            if hflip:
-                logging.debug("USB mode with hflip")
-                effective_flip = False
+        plan = None
+        if time_budget is not None:
+            profile = profile or load_profile()
+            if profile is None:
+                logging.warning("No calibration profile; ignoring the time budget (run the calibrate subcommand)")
             else:
-                logging.debug("USB mode without hflip")
-        else:  # LSB mode
-            logging.debug("Entering LSB mode processing block")
-            effective_flip = False  
-            if hflip:
-                logging.debug("LSB mode with hflip")
-                effective_flip = True
-            else:
-                logging.debug("LSB mode without hflip")
-        
-        logging.debug(f"Final orientation - mode: {mode_str}, hflip: {hflip}, effective_flip: {effective_flip}")
-        
-        os.makedirs(output_dir, exist_ok=True)
+                # Banding asked for by the caller (or needed to stream) stays
+                plan = plan_render(profile, width, height, time_budget, sampleRate, duration, max_freq,
+                                   allow_downscale, output_file == '-' or bool(tile_rows), loudness is not None)
+                backend, workers, tile_rows = plan['backend'], plan['workers'], tile_rows or plan['tile_rows']
+                if plan['width'] < width:
+                    maxpixelwidth = plan['width']
+                    source_key, load = image_source(text, image_path, image, font_size, hflip, maxpixelwidth)
+                    image_key, im = prepare_image(source_key, load, maxpixelwidth, rotate_180)
+                    width, height = im.size
+                log_plan(output_file, plan)
+        effective_flip = orientation_flip(mode, hflip)
+        # Synthesize at the lowest rate the passband needs and upsample to sampleRate
+        synth_rate = synthesis_rate(sampleRate, max_freq)
+
+        if output_file == '-':
+            # Stream to stdout through the row loop so the reader can start at once
+            tile_rows = tile_rows or STREAM_TILE_ROWS
+
+        if tile_rows:
+            # Pre-process and smooth the image band by band, streaming the rows
+            # through synthesis into the file; nothing is held per image
+            stats = image_statistics(im, tile_rows)
+            smoothed_rows = iter_smoothed_rows(im, stats, invert, tile_rows)
+            synth_width = width
+            runs = []
+            if compact:
+                # One extra banded pass finds the margins without holding the image
+                columns = active_columns(iter_smoothed_rows(im, stats, invert, tile_rows), stats['noise_threshold'])
+                synth_width = len(range(width)[columns])
+                def record_runs(pairs):
+                    # Note run lengths as they stream past for the report
+                    for row, count in pairs:
+                        runs.append(count)
+                        yield row, count
+                smoothed_rows = record_runs(iter_compacted_rows(smoothed_rows, stats['noise_threshold'], columns))
+            # Same seed as the untiled path would derive, so both give the same bytes
+            seed = input_seed((image_key, invert, compact)) if phase_seed is None else phase_seed
+            phases = plan_phases(column_frequencies(synth_width, min_freq, max_freq, effective_flip),
+                                 duration, synth_rate, phase_method, seed)
+            row_paprs = []
+            normalizer = None if loudness is None else LoudnessNormalizer(sampleRate, loudness, true_peak)
+            with open_output(output_file, sampleRate, duration, output_format) as f:
+                rows = synthesize_rows(smoothed_rows, synth_width, height, stats['noise_threshold'],
+                                       min_freq, max_freq, effective_flip, synth_rate, duration,
+                                       progress_callback, cancel_token, phases, peak_normalize, compact,
+                                       backend=backend)
+                blocks = resample_rows(rows, synth_rate, sampleRate)
+                if normalizer:
+                    blocks = normalizer.stream(blocks)
+                for samples in blocks:
+                    f.writeframes(samples.tobytes())
+                    if (phase_method != 'random' or phase_seed is not None) and np.any(samples):
+                        row_paprs.append(papr_db(samples))
+            _encoded_files.pop(os.path.abspath(output_file), None)
+            if compact:
+                log_compaction(width, height, synth_width, runs, duration)
+            if row_paprs:
+                logging.info(f"Phase plan '{phase_method}': mean row PAPR {np.mean(row_paprs):.2f} dB")
+            if normalizer:
+                log_loudness(output_file, normalizer.stats())
+            if plan:
+                log_render_time(output_file, plan, time.perf_counter() - started)
+            return True
+
+        # Each stage is memoized on its own inputs, so changing e.g. only the
+        # frequency range re-runs synthesis and encoding alone
+        preprocess_key, stats, smoothed, runs = preprocess_image(image_key, im, invert, compact)
+        if compact:
+            log_compaction(width, height, smoothed.shape[1], runs, duration)
+        # With mirror, a mode change can reuse the other sideband's render
+        layout = spectral_layout(im, effective_flip) if mirror else None
+        synthesize_key, samples = synthesize_image(preprocess_key, stats, smoothed, min_freq, max_freq,
+                                                   effective_flip, synth_rate, duration, progress_callback,
+                                                   cancel_token, phase_method, phase_seed, runs, backend, layout,
+                                                   workers, peak_normalize)
+        if synth_rate != sampleRate:
+            synthesize_key, samples = resample_image(synthesize_key, samples, synth_rate, sampleRate)
+        if loudness is not None:
+            synthesize_key, samples, levels = normalize_image(synthesize_key, samples, sampleRate, loudness, true_peak)
+            log_loudness(output_file or 'pre-render', levels)
+        if phase_method != 'random' or phase_seed is not None:
+            logging.info(f"Phase plan '{phase_method}': mean row PAPR {row_papr_db(samples, int(sampleRate * duration)):.2f} dB")
+        # Without an output file the render only fills the caches
+        if output_file:
+            encode_wav(synthesize_key, samples, output_file, sampleRate, duration, output_format)
+        if plan:
+            log_render_time(output_file, plan, time.perf_counter() - started)
+        return True
+    except RenderCancelled:
+        logging.debug("Spectrogram render cancelled")
+        return False
+    except BrokenPipeError:
+        silence_stdout()
+        logging.info("Output reader went away; generation stopped")
+        return False
+    except Exception as e:
+        print(f"Error generating spectrogram: {e}")
+        return False
 
-        with wave.open(output_file, 'w') as f:
-            f.setparams((1, 2, sampleRate, int(sampleRate * duration), "NONE", "Uncompressed"))
-            edge_size = int(width * 0.05)
-            
-            # Create a gentler window function that preserves more of the image
-            # Use a modified Blackman window only at the edges
-            window = np.ones(width)
-            edge = np.blackman(edge_size * 2)
-            window[:edge_size] = edge[:edge_size]
-            window[-edge_size:] = edge[edge_size:]
-            
-            # Analyze the image to determine appropriate thresholds
-            pixel_values = []
-            for h in range(height):
-                for w in range(width):
-                    pixel_val = im.getpixel((w, h))
-                    pixel_values.append(pixel_val)
-            
-            # Calculate statistics for better thresholding
-            if pixel_values:
-                pixel_array = np.array(pixel_values)
-                min_val = np.min(pixel_array)
-                max_val = np.max(pixel_array)
-                mean_val = np.mean(pixel_array)
-                
-                # Log the image statistics for debugging
-                logging.debug(f"Image statistics - Min: {min_val}, Max: {max_val}, Mean: {mean_val}")
-                
-                # Calculate dynamic noise threshold based on image content
-                noise_threshold = min_val + ((max_val - min_val) * 0.03)  # 3% above minimum
-                
-                # Calculate contrast enhancement parameters based on image statistics
-                # For low contrast images, use more aggressive enhancement
-                dynamic_range = max_val - min_val
-                if dynamic_range < 100:  # Low contrast image
-                    contrast_factor = 15.0  # More aggressive contrast
-                    midpoint = mean_val  # Use mean as midpoint
+# ALSA device the radio's audio input is attached to
+AUDIO_DEVICE = 'plughw:CARD=2,DEV=0'
+# Time for the radio to switch to transmit after "T 1"
+PTT_SETTLE_SECONDS = 0.5
+
+class TransmitController:
+    """Run transmissions on an asyncio loop: key-up, aplay, waterfall ticks and PTT release.
+
+    Files are submitted from any thread and played back to back in one PTT
+    cycle. Each session releases PTT in a finally block, so it ends with
+    "T 0" whether the last file finished, playback failed or abort() was
+    called. start() and submit() return a concurrent.futures.Future that
+    resolves, with the number of files played, once PTT has been released.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.loop = asyncio.new_event_loop()
+        self.paths = None      # asyncio.Queue of (path, source, tag) for the running session
+        self.session = None    # asyncio.Task of the running session
+        self.done = None       # Future handed out for the running session
+        self.idle = threading.Event()
+        self.idle.set()
+        # PTT commands go through one worker so "T 0" can never overtake a "T 1"
+        # still waiting for the rig
+        self.ptt = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def submit(self, path, source=None, tag=None):
+        """Play path in the running session, keying up a new one if the rig is idle.
+
+        source, if given, is told when the file is done with through
+        source.finished(path, tag); while source.more() is true the session
+        keeps PTT keyed and leaves source.gap seconds between its files.
+        """
+        return asyncio.run_coroutine_threadsafe(self.enqueue(path, source, tag), self.loop).result()
+
+    def start(self, paths):
+        """Transmit paths in one PTT cycle and return the session's future."""
+        done = None
+        for path in paths:
+            done = self.submit(path)
+        return done
+
+    def start_ticker(self, ticker):
+        """Key up and play a Ticker until it is closed or abort() is called."""
+        return self.submit(ticker)
+
+    def abort(self):
+        """Stop the running session now; it still sends "T 0" before its future resolves."""
+        self.loop.call_soon_threadsafe(self.cancel)
+
+    def wait(self, timeout=None):
+        """Block until no session is running; returns False on timeout."""
+        return self.idle.wait(timeout)
+
+    def shutdown(self, timeout=5):
+        """Abort anything on air and wait for PTT to be released."""
+        self.abort()
+        return self.wait(timeout)
+
+    async def enqueue(self, path, source, tag):
+        if self.session is None:
+            self.paths = asyncio.Queue()
+            self.done = concurrent.futures.Future()
+            self.idle.clear()
+            self.session = self.loop.create_task(self.run_session(self.paths, self.done))
+        self.paths.put_nowait((path, source, tag))
+        return self.done
+
+    def cancel(self):
+        if self.session is not None:
+            self.session.cancel()
+
+    async def run_session(self, paths, done):
+        app = self.app
+        played = 0
+        sources = []
+        aborted = False
+        try:
+            app.is_playing = True
+            # Clear waterfall buffer before playing
+            app.ui.post(app.clear_waterfall, key='waterfall_clear')
+            # Off the loop so an abort during key-up doesn't wait for the rig
+            await asyncio.wrap_future(self.ptt.submit(app.send_hamlib_command, "T 1\n"))
+            await asyncio.sleep(PTT_SETTLE_SECONDS)
+            while True:
+                path, source, tag = await paths.get()
+                if source is not None and source not in sources:
+                    sources.append(source)
+                try:
+                    if isinstance(path, Ticker):
+                        played += 1
+                        app.update_status("Ticker on air...")
+                        await self.play_ticker(path)
+                    elif path:
+                        played += 1
+                        if source is None:
+                            app.update_status("Transmitting spectrogram...")
+                        else:
+                            app.update_status(f"Transmitting queued message {played}...")
+                        await self.play(path)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error(f"Failed to play {path}: {e}")
+                finally:
+                    if source is not None:
+                        source.finished(path, tag)
+                if paths.empty() and (source is None or not source.more()):
+                    break
+                if source is not None:
+                    # Keep PTT keyed for the gap whether the next file is ready or
+                    # still rendering; paths.get() then waits for the render too
+                    await asyncio.sleep(source.gap)
+        except asyncio.CancelledError:
+            aborted = True
+        finally:
+            # Nothing between here and "T 0" can be interrupted by a second abort
+            # or fail, so PTT is released first
+            self.session = None
+            # Queued behind any key-up still in progress; wait so the status is true
+            self.ptt.submit(app.send_hamlib_command, "T 0\n").result()
+            while not paths.empty():
+                path, source, tag = paths.get_nowait()
+                if source is not None:
+                    source.finished(path, tag)
+            app.is_playing = False
+            # Back to the preview
+            app.ui.post(app.waterfall_area.queue_draw, key='waterfall')
+            app.update_status("Transmission aborted." if aborted else "Transmit finished.")
+            self.idle.set()
+            done.set_result(played)
+            for source in sources:
+                if source.on_idle:
+                    source.on_idle()
+
+    async def play(self, path):
+        """Play path through aplay, adding a waterfall row for each chunk as it goes out."""
+        app = self.app
+        with wave.open(path, 'rb') as wf:
+            rate = wf.getframerate()
+            samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+        chunk_size = WATERFALL_FFT_SIZE
+        proc = await asyncio.create_subprocess_exec('aplay', '-D', AUDIO_DEVICE, path)
+        logging.debug("Started aplay process")
+        started = self.loop.time()
+        exited = self.loop.create_task(proc.wait())
+        position = 0
+        try:
+            while not exited.done():
+                # Wakes on the next tick or as soon as aplay exits, whichever is first
+                await asyncio.wait({exited}, timeout=chunk_size / rate)
+                # Catch up to the audio that has actually gone out
+                played_to = min(int((self.loop.time() - started) * rate), len(samples))
+                while position < played_to:
+                    chunk = samples[position:position + chunk_size]
+                    if len(chunk) < chunk_size:
+                        chunk = np.pad(chunk, (0, chunk_size - len(chunk)), 'constant')
+                    fft_data = 20 * np.log10(np.abs(np.fft.rfft(chunk))[:chunk_size // 2] + 1e-6)
+                    app.ui.post(app.add_waterfall_row, fft_data)
+                    position += chunk_size
+            if proc.returncode:
+                raise RuntimeError(f"aplay exited with status {proc.returncode}")
+            logging.debug("aplay process completed")
+        finally:
+            if proc.returncode is None:
+                proc.terminate()
+                logging.debug("Stopped aplay process")
+            exited.cancel()
+
+    async def play_ticker(self, ticker):
+        """Stream a Ticker into aplay's stdin from a worker thread until it ends."""
+        proc = subprocess.Popen(['aplay', '-D', AUDIO_DEVICE, '-t', 'raw', '-f', 'S16_LE', '-c', '1',
+                                 '-r', str(ticker.sampleRate), f'--buffer-time={TICKER_BUFFER_US}', '-'],
+                                stdin=subprocess.PIPE)
+        logging.debug("Started aplay process for the ticker")
+
+        def feed():
+            try:
+                ticker.run(proc.stdin)
+            except BrokenPipeError:
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            return proc.wait()
+
+        try:
+            returncode = await self.loop.run_in_executor(None, feed)
+            if returncode:
+                raise RuntimeError(f"aplay exited with status {returncode}")
+        finally:
+            # On abort the feeding thread notices either of these and exits by itself
+            ticker.stop()
+            if proc.poll() is None:
+                proc.terminate()
+                logging.debug("Stopped aplay process")
+
+class TransmitQueue:
+    """Transmit messages back to back, rendering upcoming ones while the current one is on air.
+
+    Items are create_spectrogram() keyword arguments, a callable returning
+    them (evaluated when the item is rendered), or the path of a WAV file
+    that is ready to go. Rendered files go to the app's TransmitController;
+    consecutive items share one PTT cycle, separated by gap seconds of
+    silence.
+    """
+
+    def __init__(self, app, gap=1.0, on_idle=None):
+        self.app = app
+        self.gap = gap
+        self.on_idle = on_idle
+        self.pending = 0  # Enqueued but not yet transmitted
+        self.epoch = 0    # Bumped by abort() so renders already under way are dropped
+        self.lock = threading.Lock()
+        self.render_queue = queue.Queue()
+        self.work_dir = None  # Created on first use, removed by close()
+        self.counter = itertools.count()
+        threading.Thread(target=self.render_worker, daemon=True).start()
+
+    def next_path(self):
+        with self.lock:
+            if self.work_dir is None:
+                self.work_dir = tempfile.mkdtemp(prefix='spectrogram-queue-')
+        return os.path.join(self.work_dir, f"queued_{next(self.counter)}.wav")
+
+    def close(self):
+        """Remove the queue's directory and any files left in it; call once the transmitter is shut down."""
+        with self.lock:
+            work_dir, self.work_dir = self.work_dir, None
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def copy_to_queue(self, wav_file):
+        """Copy a generated WAV into the queue's directory and return the copy's path."""
+        path = self.next_path()
+        shutil.copyfile(wav_file, path)
+        return path
+
+    def enqueue(self, item):
+        with self.lock:
+            self.pending += 1
+            self.render_queue.put((self.epoch, item))
+
+    def more(self):
+        with self.lock:
+            return self.pending > 0
+
+    def finished(self, path, epoch):
+        """Called by the controller once path has been played, failed or been dropped."""
+        with self.lock:
+            if epoch == self.epoch:
+                self.pending -= 1
+        if path and self.work_dir and os.path.dirname(path) == self.work_dir:
+            try:
+                os.remove(path)
+            except OSError as e:
+                # e.g. close() already removed the directory
+                logging.debug(f"Could not remove {path}: {e}")
+
+    def abort(self):
+        """Drop everything queued and stop the transmission on air."""
+        dropped = []
+        with self.lock:
+            self.epoch += 1
+            self.pending = 0
+            while True:
+                try:
+                    dropped.append(self.render_queue.get_nowait())
+                except queue.Empty:
+                    break
+        for epoch, item in dropped:
+            if isinstance(item, str):
+                self.finished(item, epoch)
+        self.app.transmitter.abort()
+
+    def render_worker(self):
+        while True:
+            epoch, item = self.render_queue.get()
+            path = None
+            try:
+                if isinstance(item, str):
+                    path = item
                 else:
-                    contrast_factor = 10.0  # Standard contrast
-                    midpoint = 50.0  # Standard midpoint
-                
-                logging.debug(f"Dynamic noise threshold: {noise_threshold}")
-                logging.debug(f"Contrast factor: {contrast_factor}, Midpoint: {midpoint}")
+                    kwargs = item() if callable(item) else dict(item)
+                    path = self.next_path()
+                    if not create_spectrogram(output_file=path, **kwargs):
+                        logging.error("Failed to render queued message")
+                        path = None
+            except Exception as e:
+                logging.error(f"Error rendering queued message: {e}")
+                path = None
+            with self.lock:
+                stale = epoch != self.epoch
+            if stale:
+                self.finished(path, epoch)
             else:
-                noise_threshold = 2.0  # Default if no pixel data
-                contrast_factor = 10.0  # Default contrast
-                midpoint = 50.0  # Default midpoint
-            
-            # Pre-process the entire image to reduce line-to-line variations
-            processed_image = np.zeros((height, width))
-            
-            # First pass: normalize and store all pixel values
-            for h in range(height):
-                for w in range(width):
-                    pixel_val = im.getpixel((w, h))
-                    
-                    # Normalize to 0-100 range based on the image's dynamic range
-                    if max_val > min_val:
-                        normalized_val = ((pixel_val - min_val) / (max_val - min_val)) * 100.0
-                    else:
-                        normalized_val = 0
-                        
-                    if invert:
-                        normalized_val = 100.0 - normalized_val
-                    
-                    # Apply contrast enhancement - make it more black and white
-                    # Use a sigmoid function to create a sharper transition
-                    enhanced_val = 100.0 / (1.0 + np.exp(-contrast_factor * (normalized_val - midpoint) / 100.0))
-                    
-                    processed_image[h, w] = enhanced_val * 1.2
-            
-            # Second pass: apply a very gentle smoothing
-            smoothed_image = np.copy(processed_image)
-            
-            # Apply a light blur only to reduce noise, not affect image details
-            for h in range(1, height-1):
-                for w in range(1, width-1):
-                    # Lighter 3x3 kernel with more weight on the center pixel
-                    kernel = np.array([
-                        [0.03, 0.05, 0.03],
-                        [0.05, 0.68, 0.05],
-                        [0.03, 0.05, 0.03]
-                    ])
-                    
-                    # Apply kernel
-                    val = 0
-                    for kh in range(3):
-                        for kw in range(3):
-                            val += processed_image[h+kh-1, w+kw-1] * kernel[kh, kw]
-                    
-                    smoothed_image[h, w] = val
-            
-            # Now generate audio from the smoothed image
-            for h in range(height):
-                data = []
-                max_amplitude = 0
-                
-                for w in range(width):
-                    vol = smoothed_image[h, w]
-                    
-                    # Apply noise floor with dynamic threshold
-                    if vol < noise_threshold:
-                        vol = 0
-                    
-                    # Apply the window function
-                    vol = vol * window[w]
-                    
-                    # Calculate frequency based on mode and flip settings
-                    if effective_flip:
-                        freq = max_freq - (w * step)  
-                        if w == 0:
-                            logging.debug(f"First pixel freq (left): {freq:.2f} Hz")
-                    else:
-                        freq = min_freq + (w * step)  
-                        if w == 0:
-                            logging.debug(f"First pixel freq (right): {freq:.2f} Hz")
-                            
-                    (sw, p) = genSine(freq, volume=vol, phase=lastphase[w], duration=duration, sampleRate=sampleRate)
-                    data.append(sw)
-                    lastphase[w] = p
-                    current_max = np.max(np.abs(sw))
-                    if current_max > max_amplitude:
-                        max_amplitude = current_max
-                    if progress_callback:
-                        progress = (width * h + w) / (width * height)
-                        progress_callback(progress)
-
-                data = np.array(data)
-                if max_amplitude > 0:
-                    scale_factor = (30000.0 / max_amplitude) * 0.75  # Reduced generated .WAV output level by 25%
-                    data = data * scale_factor
-                    data = np.clip(data, -30000, 30000)
-                final_data = np.sum(data, axis=0) / (width * 1.0)
-                final_data = np.clip(final_data, -32767, 32767)
-                f.writeframes(array.array('h', [int(x) for x in final_data]).tobytes())
-                
-                # Store this line's data for blending with the next line
-                if 'prev_lines' in locals():
-                    prev_lines.append(final_data)
-                    if len(prev_lines) > max_prev_lines:
-                        prev_lines.pop(0)
-                
-                # Blend with previous lines
-                if 'prev_lines' in locals() and len(prev_lines) > 1:
-                    pass
-                    # Removed: blended_data = np.mean(prev_lines, axis=0)
-                    # Removed: f.writeframes(array.array('h', [int(x) for x in blended_data]).tobytes())
-        
-        if text and os.path.exists(temp_text_image):
+                self.app.transmitter.submit(path, self, epoch)
+
+# Seconds per glyph column in ticker mode; shorter than image rows so text scrolls at reading speed
+TICKER_ROW_SECONDS = 0.05
+# Lines waiting to be sent before whoever feeds the ticker has to wait
+TICKER_QUEUE_LINES = 8
+# Blank rows sent between ticker lines
+TICKER_LINE_GAP = 10
+# aplay's buffer in ticker mode (microseconds); bounds how far the audio runs ahead of the text
+TICKER_BUFFER_US = 200000
+
+class Ticker:
+    """Scroll lines of text continuously on the waterfall while PTT stays keyed.
+
+    Each character is rendered once and cached as glyph columns, and every
+    glyph column is sent as one row of tones, so text reads along the
+    waterfall's time axis. One long-lived synthesize_rows() generator keeps
+    the tone phases continuous across lines, and rows go straight to
+    aplay's stdin, paced against the clock so no more than about
+    TICKER_BUFFER_US of audio is ever waiting to play. While no text is
+    waiting the ticker sends silence.
+    """
+    def __init__(self, font_size=50, mode="USB", hflip=0, min_freq=450, max_freq=2700,
+                 sampleRate=8000, row_duration=TICKER_ROW_SECONDS, backend=DEFAULT_BACKEND,
+                 max_lines=TICKER_QUEUE_LINES):
+        self.font = load_font(font_size)
+        ascent, descent = self.font.getmetrics()
+        self.height = ascent + descent
+        self.min_freq = min_freq
+        self.max_freq = max_freq
+        self.effective_flip = orientation_flip(mode, hflip)
+        self.sampleRate = sampleRate
+        self.row_duration = row_duration
+        self.backend = backend
+        self.lines = queue.Queue(maxsize=max_lines)
+        self.glyphs = {}
+        self.rows_sent = 0
+        self.stopped = threading.Event()
+
+    def put(self, line, timeout=None):
+        """Queue a line of text; blocks while the queue is full."""
+        self.lines.put((line, time.monotonic()), timeout=timeout)
+
+    def close(self):
+        """Finish once the lines already queued have been sent."""
+        self.lines.put(None)
+
+    def stop(self):
+        """Make run() return after the current row, dropping any lines still queued."""
+        self.stopped.set()
+
+    def glyph_rows(self, char):
+        """Return the volume rows (one per glyph column) for a character."""
+        rows = self.glyphs.get(char)
+        if rows is None:
+            advance = max(1, int(math.ceil(self.font.getlength(char))))
+            image = Image.new('L', (advance, self.height), color=0)
+            ImageDraw.Draw(image).text((0, 0), char, font=self.font, fill=255)
+            # Crisp on/off tones, as for rendered text messages; the glyph's
+            # bottom comes first so it reads upright, rotated 90 degrees
+            rows = self.glyphs[char] = (np.asarray(image).T[:, ::-1] > 128).astype(float)
+        return rows
+
+    def iter_rows(self):
+        """Yield volume rows: queued text as it arrives, silence while idle; ends after close()."""
+        blank = np.zeros(self.height)
+        while True:
             try:
-                os.remove(temp_text_image)
-            except:
-                pass
+                item = self.lines.get_nowait()
+            except queue.Empty:
+                yield blank
+                continue
+            if item is None:
+                return
+            line, queued_at = item
+            logging.debug(f"Ticker line started {(time.monotonic() - queued_at) * 1000:.0f} ms after it was queued")
+            for char in line:
+                yield from self.glyph_rows(char)
+            for _ in range(TICKER_LINE_GAP):
+                yield blank
+
+    def run(self, output):
+        """Synthesize rows into a binary stream until close() or stop(); returns the number of rows sent."""
+        freqs = column_frequencies(self.height, self.min_freq, self.max_freq, self.effective_flip)
+        synth_rate = synthesis_rate(self.sampleRate, self.max_freq)
+        phases = plan_phases(freqs, self.row_duration, synth_rate, 'random', input_seed(('ticker', self.height)))
+        rows = synthesize_rows(self.iter_rows(), self.height, 0, 0.5, self.min_freq, self.max_freq,
+                               self.effective_flip, synth_rate, self.row_duration,
+                               phases=phases, backend=self.backend)
+        # Pace writes against the clock: the OS pipe alone would hold seconds of
+        # idle silence ahead of any newly queued line
+        lead = TICKER_BUFFER_US / 1e6
+        started = time.monotonic()
+        sent = 0
+        for samples in resample_rows(rows, synth_rate, self.sampleRate):
+            if self.stopped.is_set():
+                break
+            output.write(samples.tobytes())
+            self.rows_sent += 1
+            sent += len(samples)
+            ahead = sent / self.sampleRate - (time.monotonic() - started)
+            if ahead < 0:
+                # Fell behind (the player underran); restart the clock from now
+                started -= ahead
+            elif ahead > lead:
+                self.stopped.wait(ahead - lead)
+        return self.rows_sent
+
+def feed_ticker(ticker, path):
+    """Queue every line of path ('-' for stdin) on the ticker, then close it."""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.strip():
+                ticker.put(line)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+        ticker.close()
+
+def create_packed_spectrogram(items, output_file="spectrogram.wav", min_freq=450, max_freq=2700, guard_band=100,
+                              mode="USB", hflip=0, sampleRate=8000, duration=0.10, maxpixelwidth=MAX_PIXEL_WIDTH,
+                              align='start', progress_callback=None, cancel_token=None,
+                              phase_method='random', phase_seed=None, backend=DEFAULT_BACKEND,
+                              output_format='wav', loudness=None, true_peak=TRUE_PEAK_CEILING_DBFS,
+                              peak_normalize=False):
+    """Send several texts or images side by side, each in its own sub-band of one transmission.
+
+    items are dicts with text, image_path or image and optionally font_size,
+    hflip, invert and rotation, as for create_spectrogram(). Sub-bands are
+    proportional to item width and separated by guard_band Hz, listed
+    left to right as seen on the waterfall. All columns are synthesized
+    together as one oscillator bank; items with fewer rows are padded with
+    silence at the end, both ends or the start (align 'start', 'center' or
+    'end').
+    """
+    if not items:
+        print("Error: Nothing to pack.")
+        return False
+    if align not in PACK_ALIGNMENTS:
+        print(f"Error: Unknown alignment: {align}")
+        return False
+    usable = (max_freq - min_freq) - guard_band * (len(items) - 1)
+    if usable <= 0:
+        print("Error: Guard bands leave no room in the passband.")
+        return False
+
+    try:
+        def prepare(item, width_limit):
+            item_hflip = item.get('hflip', hflip)
+            if not item.get('text') and item.get('image') is None and not os.path.exists(item.get('image_path') or ''):
+                raise FileNotFoundError(f"Image file not found: {item.get('image_path')}")
+            source_key, load = image_source(item.get('text'), item.get('image_path'), item.get('image'),
+                                            item.get('font_size', 50), item_hflip, width_limit)
+            rotate_180 = not item.get('text') and item.get('rotation', 0) == 0
+            return prepare_image(source_key, load, width_limit, rotate_180)
+
+        prepared = [prepare(item, maxpixelwidth) for item in items]
+        # Share the usual number of tones between the items
+        total_width = sum(im.size[0] for _, im in prepared)
+        if total_width > maxpixelwidth:
+            prepared = [prepare(item, max(2, maxpixelwidth * im.size[0] // total_width))
+                        for item, (_, im) in zip(items, prepared)]
+
+        effective_flip = orientation_flip(mode, hflip)
+        volumes = []
+        preprocess_keys = []
+        for item, (image_key, im) in zip(items, prepared):
+            preprocess_key, stats, smoothed, _ = preprocess_image(image_key, im, item.get('invert', 1))
+            preprocess_keys.append(preprocess_key)
+            # Gate each item against its own noise floor before mixing
+            volumes.append(np.where(smoothed < stats['noise_threshold'], 0.0, smoothed))
+
+        height = max(v.shape[0] for v in volumes)
+        widths = [v.shape[1] for v in volumes]
+        # Waterfall order is rising frequency unless the mode mirrors the image
+        order = range(len(items)) if effective_flip else reversed(range(len(items)))
+        low = min_freq
+        bands = {}
+        for i in order:
+            band = usable * widths[i] / sum(widths)
+            bands[i] = (low, low + band)
+            low += band + guard_band
+
+        columns, freqs, window = [], [], []
+        for i, v in enumerate(volumes):
+            lo, hi = bands[i]
+            logging.debug(f"Packed item {i}: {widths[i]} columns, {v.shape[0]} rows, {lo:.1f}-{hi:.1f} Hz")
+            pad = height - v.shape[0]
+            before = {'start': 0, 'center': pad // 2, 'end': pad}[align]
+            columns.append(np.pad(v, ((before, pad - before), (0, 0))))
+            freqs.append(column_frequencies(widths[i], lo, hi, effective_flip))
+            window.append(column_window(widths[i]))
+        matrix = np.hstack(columns)
+        freqs = np.concatenate(freqs)
+        window = np.concatenate(window)
+
+        seed = input_seed((tuple(preprocess_keys), guard_band, align)) if phase_seed is None else phase_seed
+        synth_rate = synthesis_rate(sampleRate, max_freq)
+        phases = plan_phases(freqs, duration, synth_rate, phase_method, seed)
+        normalizer = None if loudness is None else LoudnessNormalizer(sampleRate, loudness, true_peak)
+        with open_output(output_file, sampleRate, duration, output_format) as f:
+            # Rows are already gated, so any volume above zero is a tone
+            rows = synthesize_rows(matrix, matrix.shape[1], height, np.finfo(float).tiny, min_freq, max_freq,
+                                   effective_flip, synth_rate, duration, progress_callback, cancel_token,
+                                   phases, peak_normalize, freqs=freqs, window=window, backend=backend)
+            blocks = resample_rows(rows, synth_rate, sampleRate)
+            if normalizer:
+                blocks = normalizer.stream(blocks)
+            for samples in blocks:
+                f.writeframes(samples.tobytes())
+        _encoded_files.pop(os.path.abspath(output_file), None)
+        if normalizer:
+            log_loudness(output_file, normalizer.stats())
+        logging.info(f"Packed {len(items)} messages into {height * duration:.2f} s "
+                     f"instead of {sum(v.shape[0] for v in volumes) * duration:.2f} s back to back")
         return True
+    except RenderCancelled:
+        logging.debug("Packed spectrogram render cancelled")
+        return False
+    except BrokenPipeError:
+        silence_stdout()
+        logging.info("Output reader went away; generation stopped")
+        return False
     except Exception as e:
-        print(f"Error generating spectrogram: {e}")
+        print(f"Error generating packed spectrogram: {e}")
         return False
 
+# Zero-padding factor of the decoder's FFT, so columns fall between bins smoothly
+DECODE_OVERSAMPLE = 4
+# Side of the square window SSIM is computed over
+SSIM_WINDOW = 7
+
+def read_wav(path):
+    """Return (float samples, sample rate) from a mono 16-bit WAV file."""
+    with wave.open(path, 'r') as f:
+        if f.getsampwidth() != 2 or f.getnchannels() != 1:
+            raise ValueError(f"{path}: expected mono 16-bit audio")
+        return np.frombuffer(f.readframes(f.getnframes()), dtype=np.int16).astype(np.float64), f.getframerate()
+
+def decode_samples(samples, width, min_freq=450, max_freq=2700, effective_flip=True, sampleRate=8000, duration=0.10):
+    """Rebuild the image a waterfall shows: one windowed FFT per row, read at each column's tone.
+
+    samples may carry leading batch dimensions (equal-length recordings
+    stacked together); the result is (..., rows, width) magnitudes.
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    row_samples = int(sampleRate * duration)
+    height = samples.shape[-1] // row_samples
+    frames = samples[..., :height * row_samples].reshape(samples.shape[:-1] + (height, row_samples))
+    nfft = row_samples * DECODE_OVERSAMPLE
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(row_samples), nfft, axis=-1))
+
+    # Interpolate linearly between the bins either side of each column's tone
+    bins = column_frequencies(width, min_freq, max_freq, effective_flip) * nfft / sampleRate
+    low = np.clip(np.floor(bins).astype(int), 0, spectrum.shape[-1] - 2)
+    frac = bins - low
+    return spectrum[..., low] * (1 - frac) + spectrum[..., low + 1] * frac
+
+def reference_image(text=None, image_path=None, image=None, font_size=50, hflip=0, invert=1, rotation=0,
+                    maxpixelwidth=MAX_PIXEL_WIDTH, compact=False):
+    """Return the volumes synthesis actually sends for this input (gated, windowed, runs expanded)."""
+    source_key, load = image_source(text, image_path, image, font_size, hflip, maxpixelwidth)
+    image_key, im = prepare_image(source_key, load, maxpixelwidth, not text and rotation == 0)
+    _, stats, smoothed, runs = preprocess_image(image_key, im, invert, compact)
+    volumes = np.where(smoothed < stats['noise_threshold'], 0.0, smoothed) * column_window(smoothed.shape[1])
+    return np.repeat(volumes, runs, axis=0) if runs is not None else volumes
+
+def normalize_rows(matrix):
+    """Scale every row to a peak of 1, as synthesis does; silent rows stay zero."""
+    peak = np.max(matrix, axis=-1, keepdims=True)
+    return np.divide(matrix, peak, out=np.zeros_like(matrix, dtype=np.float64), where=peak > 0)
+
+def box_mean(x, size):
+    """Mean over every size x size window of the last two axes (valid positions only)."""
+    c = np.cumsum(np.cumsum(x, axis=-2), axis=-1)
+    c = np.pad(c, [(0, 0)] * (c.ndim - 2) + [(1, 0), (1, 0)])
+    return (c[..., size:, size:] - c[..., :-size, size:] - c[..., size:, :-size] + c[..., :-size, :-size]) / size ** 2
+
+def score_images(reference, decoded):
+    """Return {'psnr': dB, 'ssim': index} comparing row-normalized images.
+
+    decoded may be a batch (..., rows, width); reference broadcasts against
+    it and both are cropped to the shorter height.
+    """
+    height = min(reference.shape[-2], decoded.shape[-2])
+    ref = normalize_rows(reference[..., :height, :])
+    dec = normalize_rows(decoded[..., :height, :])
+    mse = np.mean((ref - dec) ** 2, axis=(-2, -1))
+    psnr = 10 * np.log10(1.0 / np.maximum(mse, 1e-12))
+
+    size = max(1, min(SSIM_WINDOW, height, ref.shape[-1]))
+    ref, dec = np.broadcast_arrays(ref, dec)
+    mu_r, mu_d = box_mean(ref, size), box_mean(dec, size)
+    var_r = box_mean(ref * ref, size) - mu_r ** 2
+    var_d = box_mean(dec * dec, size) - mu_d ** 2
+    cov = box_mean(ref * dec, size) - mu_r * mu_d
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    ssim = ((2 * mu_r * mu_d + c1) * (2 * cov + c2)) / ((mu_r ** 2 + mu_d ** 2 + c1) * (var_r + var_d + c2))
+    return {'psnr': psnr, 'ssim': np.mean(ssim, axis=(-2, -1))}
+
+def score_spectrogram(wav_files, reference, min_freq=450, max_freq=2700, mode="USB", hflip=0, duration=0.10):
+    """Decode WAV files made from reference and score them as one batch.
+
+    Returns (decoded images, {'psnr': array, 'ssim': array}) with one entry per file.
+    """
+    recordings = [read_wav(path) for path in wav_files]
+    rates = {rate for _, rate in recordings}
+    if len(rates) != 1:
+        raise ValueError("All files in a batch must share one sample rate")
+    # Pad to a common length so the whole batch goes through one FFT
+    length = max(len(x) for x, _ in recordings)
+    batch = np.stack([np.pad(x, (0, length - len(x))) for x, _ in recordings])
+    decoded = decode_samples(batch, reference.shape[1], min_freq, max_freq, orientation_flip(mode, hflip),
+                             rates.pop(), duration)
+    return decoded, score_images(reference, decoded)
+
+# FFT size of the live waterfall analyzer; the preview uses the same bins and timing
+WATERFALL_FFT_SIZE = 1024
+# How far below the strongest tone the preview still shows detail, in dB
+PREVIEW_RANGE_DB = 60
+_preview_cache = StageCache('preview', 16)
+
+def preview_waterfall(volumes, min_freq=450, max_freq=2700, effective_flip=True, sampleRate=8000, duration=0.10,
+                      max_rows=100):
+    """Predict the live waterfall for a volume matrix without synthesizing any audio.
+
+    Returns uint8 intensities with one row per analyzer FFT (at most
+    max_rows, spread evenly over the whole message) and one column per
+    FFT bin from 0 Hz up to sampleRate / 2, in transmit order. Each tone is
+    smeared over neighbouring bins and over the rows an FFT straddles,
+    as the analyzer blurs it.
+    """
+    height, width = volumes.shape
+    bins = WATERFALL_FFT_SIZE // 2
+    if height == 0 or width == 0:
+        return np.zeros((0, bins), dtype=np.uint8)
+
+    freqs = column_frequencies(width, min_freq, max_freq, effective_flip)
+    key = (hashlib.sha1(freqs.tobytes()).hexdigest(), height, sampleRate, duration, max_rows)
+    cached = _preview_cache.get(key)
+    if cached is None:
+        # Each tone spreads about one analyzer bin either side
+        bin_hz = sampleRate / WATERFALL_FFT_SIZE
+        spread = np.exp(-0.5 * ((np.arange(bins) * bin_hz - freqs[:, None]) / bin_hz) ** 2)
+        # Each FFT averages the image rows its span overlaps
+        chunk = WATERFALL_FFT_SIZE / sampleRate
+        chunks = int(np.ceil(height * duration / chunk))
+        starts = np.linspace(0, chunks - 1, min(chunks, max_rows))[:, None] * chunk
+        row_starts = np.arange(height)[None, :] * duration
+        overlap = np.minimum(starts + chunk, row_starts + duration) - np.maximum(starts, row_starts)
+        cached = _preview_cache.put(key, (np.clip(overlap, 0, None) / chunk, spread))
+    overlap, spread = cached
+
+    # Synthesis scales every row to the same peak, so the preview does too
+    magnitude = overlap @ normalize_rows(volumes) @ spread
+    peak = magnitude.max()
+    if peak <= 0:
+        return np.zeros((len(overlap), bins), dtype=np.uint8)
+    db = 20 * np.log10(np.maximum(magnitude / peak, 1e-12))
+    return ((np.clip(db, -PREVIEW_RANGE_DB, 0) + PREVIEW_RANGE_DB) * (255.0 / PREVIEW_RANGE_DB)).astype(np.uint8)
+
+def benchmark_resampling(text="CQ DE W2JON", sampleRate=48000, repeat=3, min_freq=450, max_freq=2700,
+                         duration=0.10, backend=DEFAULT_BACKEND):
+    """Time direct synthesis at sampleRate against low-rate synthesis plus upsampling.
+
+    Returns a dict with the best-of-repeat times and, for both outputs,
+    the decoder's SSIM against the input and the share of energy (dB) more
+    than 500 Hz above max_freq.
+    """
+    source_key, load = image_source(text)
+    image_key, im = prepare_image(source_key, load)
+    preprocess_key, stats, smoothed, _ = preprocess_image(image_key, im, 1)
+    reference = reference_image(text)
+    synth_rate = synthesis_rate(sampleRate, max_freq)
+
+    def best_time(render):
+        times = []
+        for _ in range(repeat):
+            _synthesize_cache.clear()
+            start = time.perf_counter()
+            samples = render()
+            times.append(time.perf_counter() - start)
+        return min(times), samples
+
+    def synthesize(rate):
+        return synthesize_image(preprocess_key, stats, smoothed, min_freq, max_freq, True, rate, duration,
+                                backend=backend)[1]
+
+    direct_time, direct = best_time(lambda: synthesize(sampleRate))
+    synth_time, low = best_time(lambda: synthesize(synth_rate))
+    upsample_time, resampled = best_time(lambda: upsample(low, synth_rate, sampleRate))
+    result = {'sample_rate': sampleRate, 'synthesis_rate': synth_rate, 'direct_s': direct_time,
+              'low_rate_synthesis_s': synth_time, 'upsample_s': upsample_time,
+              'speedup': direct_time / (synth_time + upsample_time)}
+    for name, samples in (('direct', direct), ('resampled', resampled)):
+        decoded = decode_samples(samples.astype(np.float64), reference.shape[1], min_freq, max_freq, True,
+                                 sampleRate, duration)
+        power = np.abs(np.fft.rfft(samples.astype(np.float64))) ** 2
+        above = power[np.fft.rfftfreq(len(samples), 1 / sampleRate) > max_freq + 500].sum()
+        result[name] = {'ssim': float(score_images(reference, decoded)['ssim']),
+                        'out_of_band_db': float(10 * np.log10(max(above, 1e-20) / power.sum()))}
+    return result
+
+# Where calibrate stores this machine's stage timings
+PROFILE_PATH = os.path.join(os.path.expanduser('~'), '.spectrogram-profile.json')
+PROFILE_VERSION = 1
+# The governor plans for this share of the budget, leaving room for prediction error
+GOVERNOR_MARGIN = 0.9
+# Narrowest image the governor scales down to, and the step between widths it tries
+GOVERNOR_MIN_WIDTH = 32
+GOVERNOR_WIDTH_STEP = 0.8
+# Share of physical memory an untiled render may use before it is done in bands
+GOVERNOR_MEMORY_SHARE = 0.25
+GOVERNOR_TILE_ROWS = 64
+
+def best_of(repeat, func):
+    """Return the shortest of repeat timed runs of func()."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def calibrate(repeat=3, sampleRate=8000, duration=0.10):
+    """Micro-benchmark the pipeline stages on this machine and return the profile.
+
+    Synthesis is fitted per backend as a cost per row plus a cost per
+    tone sample, with the speedup measured for each worker count up to
+    the number of CPUs. Preprocessing is per pixel; resampling, WAV
+    writing and loudness normalization are per output sample.
+    """
+    rng = np.random.default_rng(0)
+    spr = int(sampleRate * duration)
+    cpus = os.cpu_count() or 1
+    profile = {'version': PROFILE_VERSION, 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'machine': platform.node(), 'cpus': cpus, 'memory_bytes': physical_memory(), 'synthesis': {}}
+
+    im = Image.fromarray(rng.integers(0, 256, (64, 128), dtype=np.uint8), 'L')
+    def preprocess():
+        stats = image_statistics(im)
+        list(iter_smoothed_rows(im, stats, 1))
+    profile['preprocess_per_pixel'] = best_of(repeat, preprocess) / (64 * 128)
+
+    for backend, rows in (('vectorized', 8), ('reference', 2)):
+        def synthesize(width, rows=rows, workers=1):
+            matrix = rng.uniform(20, 100, (rows, width))
+            phases = [0.0] * width
+            if workers > 1:
+                return lambda: synthesize_parallel(matrix, width, rows, 10, sampleRate=sampleRate, duration=duration,
+                                                   phases=phases, backend=backend, workers=workers)
+            return lambda: list(synthesize_rows(matrix, width, rows, 10, sampleRate=sampleRate, duration=duration,
+                                                phases=phases, backend=backend))
+        narrow = best_of(repeat, synthesize(32))
+        wide = best_of(repeat, synthesize(128))
+        per_tone_sample = max(0.0, (wide - narrow) / (rows * 96 * spr))
+        per_row = max(0.0, narrow / rows - per_tone_sample * 32 * spr)
+        # Enough rows per worker that thread start-up doesn't swamp the measurement
+        speedup = {'1': 1.0}
+        workers = 2
+        while workers <= min(cpus, 8):
+            single = best_of(repeat, synthesize(64, rows * workers))
+            speedup[str(workers)] = single / best_of(repeat, synthesize(64, rows * workers, workers))
+            workers *= 2
+        profile['synthesis'][backend] = {'per_row': per_row, 'per_tone_sample': per_tone_sample, 'speedup': speedup}
+
+    samples = (rng.standard_normal(sampleRate) * 3000).astype(np.int16)
+    profile['resample_per_sample'] = best_of(repeat, lambda: upsample(samples, sampleRate, sampleRate * 6)) / (sampleRate * 6)
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'calibrate.wav')
+        long_samples = np.tile(samples, 10)
+        def write():
+            with open_wav_writer(path, sampleRate, duration) as f:
+                f.writeframes(long_samples.tobytes())
+        profile['write_per_sample'] = best_of(repeat, write) / len(long_samples)
+    profile['normalize_per_sample'] = best_of(repeat, lambda: list(LoudnessNormalizer(sampleRate).stream([samples]))) / len(samples)
+    return profile
+
+def save_profile(profile, path=PROFILE_PATH):
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=2)
+
+_profiles = {}
+
+def load_profile(path=PROFILE_PATH):
+    """Return the calibration profile stored at path, or None if there is none (or it is outdated)."""
+    if path not in _profiles:
+        try:
+            with open(path) as f:
+                profile = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if profile.get('version') != PROFILE_VERSION:
+            return None
+        _profiles[path] = profile
+    return _profiles[path]
+
+def predict_render(profile, width, height, backend=DEFAULT_BACKEND, workers=1, sampleRate=8000, duration=0.10,
+                   max_freq=2700, loudness=False):
+    """Predict the seconds a render of a width x height image takes on the profiled machine."""
+    synth_rate = synthesis_rate(sampleRate, max_freq)
+    out_samples = height * int(sampleRate * duration)
+    cost = profile['synthesis'][backend]
+    seconds = width * height * profile['preprocess_per_pixel']
+    seconds += height * (cost['per_row'] + cost['per_tone_sample'] * width * int(synth_rate * duration)) / \
+        cost['speedup'][str(workers)]
+    if synth_rate != sampleRate:
+        seconds += out_samples * profile['resample_per_sample']
+    seconds += out_samples * profile['write_per_sample']
+    if loudness:
+        seconds += out_samples * profile['normalize_per_sample']
+    return seconds
+
+def plan_render(profile, width, height, time_budget, sampleRate=8000, duration=0.10, max_freq=2700,
+                allow_downscale=False, streaming=False, loudness=False):
+    """Choose backend, workers, tile rows and image width for a render that should fit time_budget.
+
+    The full width is kept whenever some backend and worker count fits;
+    otherwise, if allow_downscale is set, the widest width that fits is
+    used. Renders too big for memory (or streamed) are done in bands with
+    one worker. Returns a dict of the choices, the predicted seconds and
+    whether the plan fits.
+    """
+    memory = profile.get('memory_bytes') or physical_memory()
+    out_samples = height * int(sampleRate * duration)
+    # Whole output, the upsampler's float copy and the smoothed image
+    untiled_bytes = out_samples * 10 + width * height * 24
+    tiled = streaming or (memory is not None and untiled_bytes > memory * GOVERNOR_MEMORY_SHARE)
+
+    widths = [width]
+    while allow_downscale and int(widths[-1] * GOVERNOR_WIDTH_STEP) >= GOVERNOR_MIN_WIDTH:
+        widths.append(int(widths[-1] * GOVERNOR_WIDTH_STEP))
+    plan = None
+    for w in widths:
+        # Scaling the width scales the rows with it
+        rows = max(1, round(height * w / width))
+        options = []
+        for backend, cost in profile['synthesis'].items():
+            for workers in ([1] if tiled else sorted(int(n) for n in cost['speedup'])):
+                options.append((predict_render(profile, w, rows, backend, workers, sampleRate, duration, max_freq,
+                                               loudness), workers, backend))
+        predicted, workers, backend = min(options)
+        plan = {'backend': backend, 'workers': workers, 'width': w, 'rows': rows,
+                'tile_rows': (STREAM_TILE_ROWS if streaming else GOVERNOR_TILE_ROWS) if tiled else None,
+                'predicted_s': predicted, 'budget_s': time_budget, 'allow_downscale': allow_downscale,
+                'fits': predicted <= time_budget * GOVERNOR_MARGIN}
+        if plan['fits']:
+            break
+    return plan
+
+def log_plan(output_file, plan):
+    layout = f"bands of {plan['tile_rows']} rows" if plan['tile_rows'] else "whole image"
+    logging.info(f"Render plan ({output_file}): {plan['backend']} backend, {plan['workers']} worker(s), {layout}, "
+                 f"{plan['width']} columns; predicted {plan['predicted_s']:.2f} s of a {plan['budget_s']:.2f} s budget")
+    if not plan['fits']:
+        logging.warning(f"Render plan ({output_file}): predicted to overrun the budget"
+                        + ("" if plan['allow_downscale'] else "; allow downscaling to go faster"))
+
+def log_render_time(output_file, plan, seconds):
+    logging.info(f"Render ({output_file}): took {seconds:.2f} s, predicted {plan['predicted_s']:.2f} s, "
+                 f"budget {plan['budget_s']:.2f} s")
+
+# Stored reference outputs any synthesis change is checked against
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+# Largest per-sample difference (in int16 steps) a backend may show against the corpus
+GOLDEN_TOLERANCE = 2
+# Small renders keep the stored WAV files small
+GOLDEN_SETTINGS = {'maxpixelwidth': 64, 'font_size': 24, 'sampleRate': 8000, 'duration': 0.05,
+                   'min_freq': 450, 'max_freq': 2700}
+GOLDEN_CASES = [
+    {'name': 'text-usb', 'text': 'CQ DE W2JON', 'mode': 'USB'},
+    {'name': 'text-lsb', 'text': 'CQ DE W2JON', 'mode': 'LSB'},
+    {'name': 'text-hflip-schroeder-usb', 'text': 'DE W2JON', 'mode': 'USB', 'hflip': 1, 'phase_method': 'schroeder',
+     'peak_normalize': True},
+    {'name': 'image-usb', 'image': True, 'mode': 'USB', 'invert': 0},
+    {'name': 'image-lsb', 'image': True, 'mode': 'LSB', 'invert': 0},
+    {'name': 'image-compact-lsb', 'image': True, 'mode': 'LSB', 'invert': 0, 'compact': True},
+    # Compaction narrows this one below the 20 columns column_window() softens edges on
+    {'name': 'image-narrow-compact-usb', 'image': True, 'band': 5, 'mode': 'USB', 'invert': 0, 'compact': True},
+]
+
+def golden_test_image(width=64, height=48, band=None):
+    """Return the synthetic image the golden corpus uses: gradient, ring, bars and blank rows.
+
+    With band, only that many columns in the middle are kept and the rest is black.
+    """
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = (x + y) * 255.0 / (width + height)
+    pixels[np.abs(np.hypot(x - width / 2, y - height / 2) - height / 3) < 2] = 255
+    pixels[:, ::8] = 0
+    # Blank and repeated rows give compaction something to do
+    pixels[:4] = 0
+    pixels[-8:] = pixels[-8]
+    if band:
+        start = (width - band) // 2
+        pixels[:, :start] = 0
+        pixels[:, start + band:] = 0
+    return Image.fromarray(pixels.astype(np.uint8), 'L')
+
+def render_golden_case(case, im, backend=DEFAULT_BACKEND):
+    """Synthesize a golden case from its stored (already prepared) input image."""
+    settings = dict(GOLDEN_SETTINGS, **case.get('settings', {}))
+    image_key, im = prepare_image(('image', image_digest(im)), lambda: im, im.size[0])
+    preprocess_key, stats, smoothed, runs = preprocess_image(image_key, im, case.get('invert', 1),
+                                                             case.get('compact', False))
+    _, samples = synthesize_image(preprocess_key, stats, smoothed, settings['min_freq'], settings['max_freq'],
+                                  orientation_flip(case['mode'], case.get('hflip', 0)), settings['sampleRate'],
+                                  settings['duration'], phase_method=case.get('phase_method', 'random'),
+                                  phase_seed=case['phase_seed'], runs=runs, backend=backend,
+                                  peak_normalize=case.get('peak_normalize', False))
+    return samples
+
+def golden_case_seed(case, settings=GOLDEN_SETTINGS):
+    """Return (prepared image, phase seed) for a case, derived the way create_spectrogram() does."""
+    text = case.get('text')
+    image = golden_test_image(band=case.get('band')) if case.get('image') else None
+    source_key, load = image_source(text, image=image, font_size=settings['font_size'],
+                                    hflip=case.get('hflip', 0), maxpixelwidth=settings['maxpixelwidth'])
+    image_key, im = prepare_image(source_key, load, settings['maxpixelwidth'], rotate_180=text is None)
+    # synthesize_image() seeds from the preprocess stage key
+    preprocess_key = preprocess_image(image_key, im, case.get('invert', 1), case.get('compact', False))[0]
+    return im, input_seed(preprocess_key)
+
+def update_golden(corpus_dir=GOLDEN_DIR):
+    """Regenerate the golden corpus with the reference backend."""
+    os.makedirs(corpus_dir, exist_ok=True)
+    settings = GOLDEN_SETTINGS
+    manifest = {'settings': settings, 'tolerance': GOLDEN_TOLERANCE, 'cases': []}
+    for case in GOLDEN_CASES:
+        case = dict(case)
+        # Record the seed create_spectrogram() derives, so the corpus pins that down too
+        im, case['phase_seed'] = golden_case_seed(case, settings)
+        case['input'] = case['name'] + '.png'
+        case['output'] = case['name'] + '.wav'
+        im.save(os.path.join(corpus_dir, case['input']))
+
+        samples = render_golden_case(case, im, 'reference')
+        with open_wav_writer(os.path.join(corpus_dir, case['output']), settings['sampleRate'], settings['duration']) as f:
+            f.writeframes(samples.tobytes())
+        case['sha1'] = hashlib.sha1(samples.tobytes()).hexdigest()
+        manifest['cases'].append(case)
+        logging.info(f"Golden case {case['name']}: {len(samples)} samples")
+    with open(os.path.join(corpus_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write('\n')
+
+def check_golden(backend=DEFAULT_BACKEND, tolerance=None, corpus_dir=GOLDEN_DIR):
+    """Render every golden case with backend and compare it to the stored output.
+
+    Returns a list of per-case dicts (name, passed, seed_ok, max_diff,
+    snr_db); a case passes when the phase seed create_spectrogram() would
+    derive is still the stored one, lengths match and no sample differs by
+    more than tolerance (the corpus' stated tolerance by default).
+    """
+    with open(os.path.join(corpus_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if tolerance is None:
+        tolerance = manifest['tolerance']
+    results = []
+    for case in manifest['cases']:
+        case['settings'] = manifest['settings']
+        seed_ok = golden_case_seed(case, dict(GOLDEN_SETTINGS, **manifest['settings']))[1] == case['phase_seed']
+        with Image.open(os.path.join(corpus_dir, case['input'])) as im:
+            samples = render_golden_case(case, im.convert('L'), backend).astype(np.float64)
+        expected, _ = read_wav(os.path.join(corpus_dir, case['output']))
+        if len(samples) != len(expected):
+            results.append({'name': case['name'], 'passed': False, 'seed_ok': seed_ok, 'max_diff': float('inf'),
+                            'snr_db': float('-inf')})
+            continue
+        error = samples - expected
+        max_diff = float(np.max(np.abs(error))) if len(error) else 0.0
+        noise = np.sum(error ** 2)
+        snr_db = float('inf') if noise == 0 else 10 * np.log10(np.sum(expected ** 2) / noise)
+        results.append({'name': case['name'], 'passed': seed_ok and max_diff <= tolerance, 'seed_ok': seed_ok,
+                        'max_diff': max_diff, 'snr_db': snr_db})
+    return results
+
+# Quiet period after the last settings change before a background render starts
+PRERENDER_DELAY_MS = 400
+# How often the GUI polls the radio for a USB/LSB change while idle
+MODE_POLL_INTERVAL_MS = 2000
+# Output rates offered in the Settings dialog; pick the sound card's native one
+OUTPUT_SAMPLE_RATES = (8000, 44100, 48000, 96000)
+
+# How often the main loop runs posted UI updates, and how many it runs per pass
+UI_DRAIN_INTERVAL_MS = 20
+UI_DRAIN_BATCH = 50
+# Upper bucket edges (ms) of the main-loop stall and waterfall draw histograms
+UI_HISTOGRAM_EDGES_MS = (1, 5, 10, 20, 50, 100, 250, 500, 1000)
+
+class UiChannel:
+    """UI updates posted from any thread and run on the GTK main loop at a bounded rate.
+
+    Posts that share a key replace each other while pending, so a flood of
+    redraws or progress updates costs one call per drain. The drain timer
+    also measures the main loop: how late it fires is a stall.
+    """
+    def __init__(self, interval_ms=UI_DRAIN_INTERVAL_MS, batch=UI_DRAIN_BATCH):
+        self.lock = threading.Lock()
+        self.pending = OrderedDict()
+        self.serial = itertools.count()
+        self.interval_ms = interval_ms
+        self.batch = batch
+        self.posted = 0
+        self.coalesced = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.last_drain = None
+        self.timings = {name: {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                               'histogram': [0] * (len(UI_HISTOGRAM_EDGES_MS) + 1)}
+                        for name in ('stall', 'draw')}
+        GLib.timeout_add(interval_ms, self.drain)
+
+    def post(self, func, *args, key=None):
+        """Run func(*args) on the main loop; safe to call from any thread."""
+        with self.lock:
+            self.posted += 1
+            if key is None:
+                key = ('unique', next(self.serial))
+            elif key in self.pending:
+                self.coalesced += 1
+            # A replaced post keeps its place in line
+            self.pending[key] = (func, args)
+
+    def drain(self):
+        now = time.monotonic()
+        if self.last_drain is not None:
+            self.record('stall', max(0.0, (now - self.last_drain) * 1000 - self.interval_ms))
+        with self.lock:
+            self.depth = len(self.pending)
+            self.max_depth = max(self.max_depth, self.depth)
+            batch = [self.pending.popitem(last=False)[1] for _ in range(min(self.depth, self.batch))]
+        for func, args in batch:
+            try:
+                func(*args)
+            except Exception as e:
+                logging.error(f"UI update failed: {e}")
+        # Our own work is not a stall; measure from here to the next drain
+        self.last_drain = time.monotonic()
+        return True  # Keep draining
+
+    def record(self, name, ms):
+        """Add a duration in milliseconds to the named histogram."""
+        timing = self.timings[name]
+        timing['count'] += 1
+        timing['total_ms'] += ms
+        timing['max_ms'] = max(timing['max_ms'], ms)
+        timing['histogram'][bisect.bisect_left(UI_HISTOGRAM_EDGES_MS, ms)] += 1
+
+    def snapshot(self):
+        """Return the counters and histograms as a JSON-ready dict."""
+        with self.lock:
+            stats = {'queue_depth': len(self.pending), 'max_queue_depth': self.max_depth,
+                     'posted': self.posted, 'coalesced': self.coalesced,
+                     'histogram_edges_ms': list(UI_HISTOGRAM_EDGES_MS)}
+        for name, timing in self.timings.items():
+            stats[name] = dict(timing, histogram=list(timing['histogram']),
+                               mean_ms=timing['total_ms'] / timing['count'] if timing['count'] else 0.0)
+        return stats
+
 class SpectrogramApp(Gtk.Window):
     def __init__(self):
         super().__init__(title="Spectrogram Generator")
@@ -388,8 +2465,9 @@ class SpectrogramApp(Gtk.Window):
 
         self.image_file_button = Gtk.FileChooserButton(title="Select Image")
         filter_png = Gtk.FileFilter()
-        filter_png.set_name("PNG Images")
+        filter_png.set_name("Images")
         filter_png.add_mime_type("image/png")
+        filter_png.add_mime_type("image/jpeg")
         self.image_file_button.add_filter(filter_png)
         self.image_file_button.connect("file-set", self.on_image_file_button_clicked)
 
@@ -399,8 +2477,12 @@ class SpectrogramApp(Gtk.Window):
         self.button_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
         self.play_button = Gtk.Button(label="Play")
         self.play_button.connect("clicked", self.on_play_button_clicked)
+        self.queue_button = Gtk.Button(label="Queue")
+        self.queue_button.connect("clicked", self.on_queue_button_clicked)
         self.clear_button = Gtk.Button(label="Clear")
         self.clear_button.connect("clicked", self.on_clear_button_clicked)
+        self.stop_button = Gtk.Button(label="Stop")
+        self.stop_button.connect("clicked", self.on_stop_button_clicked)
 
         self.status_label = Gtk.Label(label="Please enter text or select a PNG file to generate")
         self.progress_bar = Gtk.ProgressBar()
@@ -416,7 +2498,9 @@ class SpectrogramApp(Gtk.Window):
         self.box.pack_start(self.image_file_button, False, False, 0)
         self.box.pack_start(self.text_entry, False, False, 0)
         self.button_box.pack_start(self.play_button, True, True, 0)
+        self.button_box.pack_start(self.queue_button, True, True, 0)
         self.button_box.pack_start(self.clear_button, True, True, 0)
+        self.button_box.pack_start(self.stop_button, True, True, 0)
         self.box.pack_start(self.button_box, False, False, 0)
         self.box.pack_start(self.progress_bar, False, False, 0)
         self.box.pack_start(self.waterfall_area, False, False, 0)
@@ -496,14 +2580,39 @@ class SpectrogramApp(Gtk.Window):
         self.settings_dialog = None
         self.spectrogram_data = None
         self.audio_data = None
-        self.playback_thread = None
         self.is_playing = False
         self.waterfall_top_down = True
+        self.loudness = None  # Target dBFS when loudness normalization is on
+        self.sample_rate = 8000  # Output rate of generated audio
         self.current_mode = None  
-        self.playback_lock = threading.Lock()
         self.hamlib_lock = threading.Lock()
+        self.prerender_source_id = None
+        self.prerender_thread = None
+        self.prerender_token = None
+        self.prerender_settings = None
+        self.play_token = None  # Cancels the render started by Play when Stop is pressed
+        self.polled_mode = None
+        self.mode_poll_thread = None
+        self.waterfall_preview = None
+        self.waterfall_preview_mode = None
+        self.ui = UiChannel()
+        self.debug_overlay = logging.getLogger().isEnabledFor(logging.DEBUG)
+        self.transmitter = TransmitController(self)
+        self.transmit_queue = TransmitQueue(self)
+
+        # Render in the background whenever something that affects the output changes
+        self.text_entry.connect("changed", self.schedule_prerender)
+        self.max_freq_scale.connect("value-changed", self.schedule_prerender)
+        self.min_freq_scale.connect("value-changed", self.schedule_prerender)
+        self.font_size_scale.connect("value-changed", self.schedule_prerender)
+        self.hflip_check.connect("toggled", self.schedule_prerender)
+        self.invert_check.connect("toggled", self.schedule_prerender)
+        self.rotation_combo.connect("changed", self.schedule_prerender)
 
         self.connect_to_hamlib()
+        GLib.timeout_add(MODE_POLL_INTERVAL_MS, self.poll_mode)
+        if self.debug_overlay:
+            GLib.timeout_add(1000, self.refresh_debug_overlay)
 
     def connect_to_hamlib(self):
         try:
@@ -573,6 +2682,26 @@ class SpectrogramApp(Gtk.Window):
         self.current_mode = None
         return self.get_hamlib_mode()
 
+    def poll_mode(self):
+        """Query the radio mode off the GTK thread and re-render when it changes."""
+        if not self.is_playing and getattr(self, 'hamlib_socket', None):
+            if not (self.mode_poll_thread and self.mode_poll_thread.is_alive()):
+                self.mode_poll_thread = threading.Thread(target=self.poll_mode_worker, daemon=True)
+                self.mode_poll_thread.start()
+        return True  # Keep polling
+
+    def poll_mode_worker(self):
+        mode = self.update_mode()
+        self.ui.post(self.on_mode_polled, mode)
+
+    def on_mode_polled(self, mode):
+        if mode != self.polled_mode:
+            logging.debug(f"Radio mode changed: {self.polled_mode} -> {mode}")
+            self.polled_mode = mode
+            self.mode_label.set_text(f"Mode: {mode}")
+            self.schedule_prerender()
+        return False
+
     def calculate_hash(self, text, image_path):
         hash_object = hashlib.md5()
         if text:
@@ -585,6 +2714,8 @@ class SpectrogramApp(Gtk.Window):
         hash_object.update(str(int(self.hflip_check.get_active())).encode('utf-8'))
         hash_object.update(str(int(self.invert_check.get_active())).encode('utf-8'))
         hash_object.update(str(int(self.rotation_combo.get_active() * 90)).encode('utf-8'))
+        hash_object.update(str(self.loudness).encode('utf-8'))
+        hash_object.update(str(self.sample_rate).encode('utf-8'))
         return hash_object.hexdigest()
 
     def on_play_button_clicked(self, widget):
@@ -606,12 +2737,110 @@ class SpectrogramApp(Gtk.Window):
         else:
             self.update_status("Changes detected. Generating new spectrogram...")
             self.previous_hash = current_hash
+            settings = self.read_render_settings(text, self.image_path)
+            # Keep a background render of these exact settings running, it
+            # finishes into the caches; anything else is stale
+            if self.prerender_source_id:
+                GLib.source_remove(self.prerender_source_id)
+                self.prerender_source_id = None
+            if self.prerender_token and self.prerender_settings != settings:
+                self.prerender_token.cancel()
             self.progress_bar.show()
             self.progress_bar.set_fraction(0)
             self.progress_bar.set_text("")
-            generation_thread = threading.Thread(target=self.create_spectrogram, args=(text,))
+            # Stop cancels this render, and bumps the queue's epoch so a render
+            # that finishes anyway is not transmitted
+            self.play_token = CancellationToken()
+            generation_thread = threading.Thread(target=self.create_spectrogram,
+                                                 args=(settings, self.play_token, self.transmit_queue.epoch))
             generation_thread.start()
 
+    def read_render_settings(self, text, image_path):
+        """Snapshot the widget values that affect the render (call on the GTK thread)."""
+        return {
+            'text': text,
+            'image_path': image_path,
+            'max_freq': int(self.max_freq_scale.get_value()),
+            'min_freq': int(self.min_freq_scale.get_value()),
+            'font_size': int(self.font_size_scale.get_value()),
+            'hflip': self.hflip_check.get_active(),
+            'invert': 1 if self.invert_check.get_active() else 0,
+            'rotation': self.rotation_combo.get_active() * 90,  # Convert index to degrees (0, 90, 180, 270)
+            'loudness': self.loudness,
+            'sampleRate': self.sample_rate,
+        }
+
+    def schedule_prerender(self, *args):
+        """Debounce setting changes into a single background render."""
+        # The preview is cheap enough to follow every change straight away
+        self.update_preview()
+        if self.prerender_source_id:
+            GLib.source_remove(self.prerender_source_id)
+        self.prerender_source_id = GLib.timeout_add(PRERENDER_DELAY_MS, self.start_prerender)
+
+    def start_prerender(self):
+        self.prerender_source_id = None
+        if self.prerender_token:
+            self.prerender_token.cancel()
+            self.prerender_token = None
+
+        text = self.text_entry.get_text()
+        image_file = self.image_file_button.get_file()
+        image_path = image_file.get_path() if image_file else None
+        if not text and not image_path:
+            return False
+
+        settings = self.read_render_settings(text, image_path)
+        token = CancellationToken()
+        self.prerender_token = token
+        self.prerender_settings = settings
+        self.prerender_thread = threading.Thread(target=self.prerender, args=(settings, token), daemon=True)
+        self.prerender_thread.start()
+        return False  # One-shot timeout
+
+    def update_preview(self):
+        """Rebuild the idle waterfall preview from the current settings (call on the GTK thread)."""
+        text = self.text_entry.get_text()
+        image_file = self.image_file_button.get_file()
+        image_path = image_file.get_path() if image_file else None
+        self.waterfall_preview = None
+        if text or image_path:
+            mode = self.polled_mode or "USB"
+            try:
+                kwargs = self.spectrogram_kwargs(self.read_render_settings(text, image_path), mode)
+                volumes = reference_image(kwargs['text'], kwargs['image_path'], kwargs['image'], kwargs['font_size'],
+                                          kwargs['hflip'], kwargs['invert'], kwargs['rotation'])
+                self.waterfall_preview = preview_waterfall(volumes, kwargs['min_freq'], kwargs['max_freq'],
+                                                           orientation_flip(mode, kwargs['hflip']),
+                                                           max_rows=self.waterfall_max_rows)
+                self.waterfall_preview_mode = mode
+            except Exception as e:
+                logging.error(f"Error building waterfall preview: {e}")
+        self.waterfall_area.queue_draw()
+
+    def prerender(self, settings, token):
+        """Render settings into the stage caches so Play can transmit straight away."""
+        mode = self.polled_mode or self.get_hamlib_mode()
+        logging.debug(f"Pre-rendering spectrogram in mode: {mode}")
+        try:
+            kwargs = self.spectrogram_kwargs(settings, mode)
+            if create_spectrogram(output_file=None, cancel_token=token, **kwargs):
+                logging.debug("Pre-render finished")
+        except Exception as e:
+            logging.error(f"Error pre-rendering spectrogram: {e}")
+
+    def on_stop_button_clicked(self, widget):
+        """Cancel a Play render, drop queued messages and end the transmission on air.
+
+        PTT is released before the status changes.
+        """
+        if self.is_playing or self.transmit_queue.more():
+            self.update_status("Stopping transmission...")
+        if self.play_token:
+            self.play_token.cancel()
+            self.play_token = None
+        self.transmit_queue.abort()
+
     def on_clear_button_clicked(self, widget):
         self.text_entry.set_text("")
         self.image_path = None
@@ -630,189 +2859,147 @@ class SpectrogramApp(Gtk.Window):
         self.invert_check.set_no_show_all(True)
         
         self.waterfall_data = []
+        self.waterfall_preview = None
         self.waterfall_area.queue_draw()
         self.update_status("Status: Cleared input fields")
 
-    def create_spectrogram(self, text=None):
-        """Create a spectrogram from text or image."""
+    def spectrogram_kwargs(self, settings, mode):
+        """Translate a settings snapshot into create_spectrogram() arguments for mode."""
+        text = settings['text']
+        hflip = settings['hflip']
+
+        # For transmission:
+        if mode == "USB":
+            baseline_hflip = 0  # No flip by default
+            if hflip:
+                baseline_hflip = 1  # Flip when requested
+        else:  # LSB
+            if text:
+                # Text mode: Default flip for LSB
+                baseline_hflip = 1  # Flip by default
+                if hflip:
+                    baseline_hflip = 0  # No flip when requested
+            else:
+                # PNG mode: Need flip for LSB
+                baseline_hflip = 1  # Always flip for LSB PNG
+                if hflip:
+                    baseline_hflip = 0  # Unless hflip requested
+            
+        logging.debug(f"Transmission orientation - mode: {mode}, hflip: {hflip}, baseline_hflip: {baseline_hflip}, is_text: {bool(text)}")
+        
+        # Process image if loading from PNG
+        img = None
+        if settings['image_path'] and not text:
+            # Apply rotation if specified
+            rotation = settings['rotation']
+            if rotation > 0:
+                logging.debug(f"Pre-applying {rotation} degree rotation to PNG in UI")
+            
+            # Decoded, downscaled and rotated once; shared with the file chooser preview
+            img = decode_image(settings['image_path'], MAX_PIXEL_WIDTH, rotation)
+            
+            # For LSB mode, flip the image before processing
+            if mode == "LSB":
+                img = img.transpose(Image.FLIP_LEFT_RIGHT)
+                logging.debug("LSB mode: Pre-flipping PNG image")
+        
+        return dict(text=text, image_path=settings['image_path'], max_freq=settings['max_freq'],
+                    min_freq=settings['min_freq'], font_size=settings['font_size'], hflip=baseline_hflip,
+                    invert=settings['invert'], mode=mode, rotation=0, image=img, loudness=settings['loudness'],
+                    sampleRate=settings['sampleRate'], mirror=True)
+
+    def create_spectrogram(self, settings, token=None, epoch=None):
+        """Create a spectrogram from text or image, then transmit it unless Stop was pressed meanwhile."""
         # Force update mode before encoding
         self.update_mode()  # Clear cache and get fresh mode
         mode = self.get_hamlib_mode()
         logging.debug(f"Creating spectrogram in mode: {mode}")
         
         try:
-            GLib.idle_add(self.update_status, "Generating spectrogram...")
-            max_freq = int(self.max_freq_scale.get_value())
-            min_freq = int(self.min_freq_scale.get_value())
-            font_size = int(self.font_size_scale.get_value())
-            
-            # For transmission:
-            if mode == "USB":
-                baseline_hflip = 0  # No flip by default
-                if self.hflip_check.get_active():
-                    baseline_hflip = 1  # Flip when requested
-            else:  # LSB
-                if text:
-                    # Text mode: Default flip for LSB
-                    baseline_hflip = 1  # Flip by default
-                    if self.hflip_check.get_active():
-                        baseline_hflip = 0  # No flip when requested
-                else:
-                    # PNG mode: Need flip for LSB
-                    baseline_hflip = 1  # Always flip for LSB PNG
-                    if self.hflip_check.get_active():
-                        baseline_hflip = 0  # Unless hflip requested
-                
-            logging.debug(f"Transmission orientation - mode: {mode}, hflip: {self.hflip_check.get_active()}, baseline_hflip: {baseline_hflip}, is_text: {bool(text)}")
-            
-            # Process image if loading from PNG
-            if self.image_path and not text:
-                img = Image.open(self.image_path)
-                img = img.convert('L')  # Convert to grayscale
-                
-                # Apply rotation if specified
-                rotation_index = self.rotation_combo.get_active()
-                rotation = rotation_index * 90  # Convert index to degrees (0, 90, 180, 270)
-                
-                if rotation > 0:
-                    logging.debug(f"Pre-applying {rotation} degree rotation to PNG in UI")
-                    # Use PIL's built-in rotation constants for more reliable rotation
-                    if rotation == 90:
-                        img = img.transpose(Image.ROTATE_90)
-                    elif rotation == 180:
-                        img = img.transpose(Image.ROTATE_180)
-                    elif rotation == 270:
-                        img = img.transpose(Image.ROTATE_270)
+            self.update_status("Generating spectrogram...")
+            # A background render still running is either for these settings
+            # (its result lands in the caches) or already cancelled
+            prerender_thread = self.prerender_thread
+            if prerender_thread and prerender_thread.is_alive():
+                logging.debug("Waiting for background render to finish")
+                prerender_thread.join()
+
+            kwargs = self.spectrogram_kwargs(settings, mode)
+            success = create_spectrogram(output_file=self.output_file, progress_callback=self.update_progress,
+                                         cancel_token=token, **kwargs)
                 
-                # For LSB mode, flip the image before processing
-                if mode == "LSB":
-                    img = img.transpose(Image.FLIP_LEFT_RIGHT)
-                    logging.debug("LSB mode: Pre-flipping PNG image")
-                
-                # Save the pre-processed image
-                temp_path = self.image_path + ".temp.png"
-                img.save(temp_path)
-                self.image_path = temp_path
-                logging.debug(f"Saved pre-processed image: {self.image_path}")
-            
-            invert = 1 if self.invert_check.get_active() else 0
-            success = create_spectrogram(text=text, image_path=self.image_path, output_file=self.output_file, 
-                                      max_freq=max_freq, min_freq=min_freq, font_size=font_size, 
-                                      hflip=baseline_hflip, invert=invert, progress_callback=self.update_progress, 
-                                      mode=mode, rotation=0)
-            
-            # Clean up temporary image if it exists
-            if self.image_path and self.image_path.endswith('.temp.png'):
-                try:
-                    os.remove(self.image_path)
-                    logging.debug(f"Cleaned up temporary image: {self.image_path}")
-                except Exception as e:
-                    logging.error(f"Error cleaning up temp image: {e}")
-                
-            if success and os.path.exists(self.output_file):
-                GLib.idle_add(self.update_status, "Spectrogram generated. Ready to Transmit...")
-                GLib.idle_add(self.check_mode_and_play)
+            if token is not None and token.cancelled:
+                # The output file wasn't rewritten, so don't let Play reuse it as unchanged
+                self.previous_hash = None
+                self.update_status("Generation stopped.")
+            elif success and os.path.exists(self.output_file):
+                self.update_status("Spectrogram generated. Ready to Transmit...")
+                self.ui.post(self.check_mode_and_play, epoch)
             else:
-                GLib.idle_add(self.update_status, "Failed to generate spectrogram.")
-            GLib.idle_add(self.progress_bar.hide)
+                self.update_status("Failed to generate spectrogram.")
+            self.ui.post(self.progress_bar.hide, key='progress_bar_hide')
         except Exception as e:
-            GLib.idle_add(self.update_status, f"Error generating spectrogram: {e}")
+            self.update_status(f"Error generating spectrogram: {e}")
             logging.error(f"Error generating spectrogram: {e}")
 
-    def check_mode_and_play(self):
-        if self.playback_thread and self.playback_thread.is_alive():
-            self.update_status("Waiting for previous transmission to finish...")
-            self.playback_thread.join()
-        
+    def check_mode_and_play(self, epoch=None):
+        # Stop was pressed after the render that led here started
+        if epoch is not None and epoch != self.transmit_queue.epoch:
+            logging.debug("Render finished after Stop; not transmitting it")
+            return
         self.current_mode = self.get_hamlib_mode()
         if self.current_mode:
             self.mode_label.set_text(f"Mode: {self.current_mode}")
         else:
             self.mode_label.set_text("Mode: ---")
-        self.play_audio()
-
-    def update_progress(self, fraction):
-        GLib.idle_add(self.progress_bar.set_fraction, fraction)
-        GLib.idle_add(self.progress_bar.set_text, f"{int(fraction * 100)}%")
-
-    def play_audio(self):
-        with self.playback_lock:
-            if self.is_playing:
-                return
-            
-            # Clear waterfall buffer before playing
-            self.waterfall_data = []
-            self.waterfall_area.queue_draw()
-            
-            self.is_playing = True
-            try:
-                self.send_hamlib_command("T 1\n")
-                time.sleep(0.5)
-                self.update_status("Transmitting spectrogram...")
-                with wave.open(self.output_file, 'rb') as wf:
-                    sample_rate = wf.getframerate()
-                    audio_data = wf.readframes(wf.getnframes())
-                    self.audio_data = np.frombuffer(audio_data, dtype=np.int16)
-                    self.sample_rate = sample_rate
-                
-                self.playback_thread = threading.Thread(target=self.play_and_analyze)
-                self.playback_thread.start()
-            except Exception as e:
-                self.update_status(f"Failed to start playback: {e}")
-                self.is_playing = False
+        
+        # Transmit a copy so the next render can't overwrite it while it waits its turn
+        if self.is_playing:
+            self.update_status("Queued behind the current transmission...")
+        self.transmit_queue.enqueue(self.transmit_queue.copy_to_queue(self.output_file))
 
-    def play_and_analyze(self):
-        chunk_size = 1024
-        process_rate = self.sample_rate
-        num_samples = len(self.audio_data)
-        position = 0
+    def on_queue_button_clicked(self, widget):
+        text = self.text_entry.get_text()
+        image_file = self.image_file_button.get_file()
+        image_path = image_file.get_path() if image_file else None
+        if not text and not image_path:
+            self.update_status("Error: Please enter text or select a PNG file.")
+            return
 
-        proc = subprocess.Popen(['aplay', '-D', 'plughw:CARD=2,DEV=0', self.output_file])
-        logging.debug("Started aplay process")
+        settings = self.read_render_settings(text, image_path)
+        # The radio mode is read when the queue gets round to rendering the message
+        self.transmit_queue.enqueue(lambda: self.spectrogram_kwargs(settings, self.get_hamlib_mode()))
+        self.update_status(f"Message queued ({self.transmit_queue.pending} pending)")
 
-        while position < num_samples and self.is_playing:
-            chunk = self.audio_data[position:position + chunk_size]
-            if len(chunk) < chunk_size:
-                chunk = np.pad(chunk, (0, chunk_size - len(chunk)), 'constant')
-            
-            fft_data = np.abs(np.fft.rfft(chunk))[:chunk_size // 2]
-            fft_data = 20 * np.log10(fft_data + 1e-6)
-            logging.debug(f"FFT data range: {np.min(fft_data)} to {np.max(fft_data)}")
-            
-            if self.waterfall_top_down:
-                self.waterfall_data.insert(0, fft_data)
-                if len(self.waterfall_data) > self.waterfall_max_rows:
-                    self.waterfall_data.pop()
-            else:
-                self.waterfall_data.append(fft_data)
-                if len(self.waterfall_data) > self.waterfall_max_rows:
-                    self.waterfall_data.pop(0)
-            
-            GLib.idle_add(self.waterfall_area.queue_draw)
-            
-            position += chunk_size
-            time.sleep(chunk_size / process_rate)
+    def update_progress(self, fraction):
+        self.ui.post(self.progress_bar.set_fraction, fraction, key='progress_fraction')
+        self.ui.post(self.progress_bar.set_text, f"{int(fraction * 100)}%", key='progress_text')
 
-        proc.wait()
-        logging.debug("aplay process completed")
-        self.is_playing = False
-        self.send_hamlib_command("T 0\n")
-        GLib.idle_add(self.update_status, "Transmit finished.")
+    def play_audio(self):
+        """Transmit the current output file; returns a future that resolves once PTT is released."""
+        return self.transmitter.start([self.output_file])
 
-    def draw_waterfall(self, widget, cr):
-        """Draw the waterfall display."""
-        if not self.waterfall_data:
-            return
+    def clear_waterfall(self):
+        self.waterfall_data = []
+        self.waterfall_area.queue_draw()
 
-        width = widget.get_allocated_width()
-        height = widget.get_allocated_height()
-        active_width = width * 0.8
-        x_offset = (width - active_width) / 2
+    def add_waterfall_row(self, fft_data):
+        """Add the spectrum of one chunk of transmitted audio to the waterfall."""
+        if self.waterfall_top_down:
+            self.waterfall_data.insert(0, fft_data)
+            if len(self.waterfall_data) > self.waterfall_max_rows:
+                self.waterfall_data.pop()
+        else:
+            self.waterfall_data.append(fft_data)
+            if len(self.waterfall_data) > self.waterfall_max_rows:
+                self.waterfall_data.pop(0)
+        self.waterfall_area.queue_draw()
 
+    def waterfall_flip(self, mode):
+        """Return True when the waterfall shows the audio spectrum mirrored for mode."""
         # Waterfall display:
         # For text: match transmission mode default orientation
         # For PNG: show as loaded, but flip for LSB
-        mode = self.get_hamlib_mode()
         if mode == "USB":
             # USB: flip only if requested
             flip = self.hflip_check.get_active()
@@ -823,6 +3010,67 @@ class SpectrogramApp(Gtk.Window):
             else:
                 # LSB text: Default right-to-left, flip when requested
                 flip = not self.hflip_check.get_active()
+        return flip
+
+    def draw_waterfall_preview(self, widget, cr):
+        """Draw the analytic preview in the same geometry as the live waterfall."""
+        width = widget.get_allocated_width()
+        height = widget.get_allocated_height()
+        active_width = width * 0.8
+        x_offset = (width - active_width) / 2
+        row_height = height / self.waterfall_max_rows
+
+        cr.set_source_rgb(0, 0, 0)
+        cr.paint()
+        rows = self.waterfall_preview
+        if not len(rows):
+            return
+        if self.waterfall_flip(self.waterfall_preview_mode):
+            rows = rows[:, ::-1]
+        if self.waterfall_top_down:
+            # As the live view shows it once the whole message has scrolled in
+            rows = rows[::-1]
+            y = 0
+        else:
+            y = height - len(rows) * row_height
+
+        # One image for the whole preview instead of a rectangle per bin
+        h, w = rows.shape
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_RGB24, w)
+        pixels = np.zeros((h, stride // 4), dtype=np.uint32)
+        gray = rows.astype(np.uint32)
+        pixels[:, :w] = (gray << 16) | (gray << 8) | gray
+        surface = cairo.ImageSurface.create_for_data(memoryview(pixels), cairo.FORMAT_RGB24, w, h, stride)
+        cr.save()
+        cr.translate(x_offset, y)
+        cr.scale(active_width / w, row_height)
+        cr.set_source_surface(surface, 0, 0)
+        cr.paint()
+        cr.restore()
+
+    def draw_waterfall(self, widget, cr):
+        """Draw the waterfall display, timing it for the UI statistics."""
+        start = time.perf_counter()
+        self.paint_waterfall(widget, cr)
+        self.ui.record('draw', (time.perf_counter() - start) * 1000)
+        if self.debug_overlay:
+            self.draw_debug_overlay(widget, cr)
+
+    def paint_waterfall(self, widget, cr):
+        """Paint the waterfall (the preview while nothing is playing)."""
+        if not self.is_playing and self.waterfall_preview is not None:
+            self.draw_waterfall_preview(widget, cr)
+            return
+        if not self.waterfall_data:
+            return
+
+        width = widget.get_allocated_width()
+        height = widget.get_allocated_height()
+        active_width = width * 0.8
+        x_offset = (width - active_width) / 2
+
+        mode = self.get_hamlib_mode()
+        flip = self.waterfall_flip(mode)
         
         logging.debug(f"Waterfall orientation - mode: {mode}, hflip: {self.hflip_check.get_active()}, flip: {flip}, is_png: {bool(self.image_path)}")
 
@@ -850,9 +3098,28 @@ class SpectrogramApp(Gtk.Window):
             cr.fill()
 
     def update_status(self, message):
-        self.status_label.set_text(message)
-        while Gtk.events_pending():
-            Gtk.main_iteration()
+        """Show message in the status line; safe to call from any thread."""
+        self.ui.post(self.status_label.set_text, message, key='status')
+
+    def refresh_debug_overlay(self):
+        self.waterfall_area.queue_draw()
+        return True  # Keep refreshing
+
+    def draw_debug_overlay(self, widget, cr):
+        """Print the UI channel's queue and timing counters over the waterfall (--debug)."""
+        stats = self.ui.snapshot()
+        stalls = ' '.join(f"<{edge}:{count}" for edge, count in zip(UI_HISTOGRAM_EDGES_MS, stats['stall']['histogram']))
+        lines = [
+            f"queue {stats['queue_depth']} (max {stats['max_queue_depth']}), {stats['coalesced']}/{stats['posted']} coalesced",
+            f"draw {stats['draw']['mean_ms']:.1f} ms avg, {stats['draw']['max_ms']:.1f} ms max",
+            f"stalls ms {stalls} >:{stats['stall']['histogram'][-1]} (max {stats['stall']['max_ms']:.0f})",
+        ]
+        cr.select_font_face("monospace")
+        cr.set_font_size(10)
+        cr.set_source_rgb(1.0, 0.4, 0.2)
+        for i, line in enumerate(lines):
+            cr.move_to(4, 12 + 11 * i)
+            cr.show_text(line)
 
     def show_about_dialog(self, widget):
         about_dialog = Gtk.AboutDialog()
@@ -897,11 +3164,13 @@ class SpectrogramApp(Gtk.Window):
             logging.debug(f"Image loaded, showing rotation and invert controls: {self.image_path}")
         
         self.queue_draw()
+        self.schedule_prerender()
 
     def load_spectrogram_data(self, image_path):
         if os.path.exists(image_path):
-            image = Image.open(image_path)
-            return np.array(image.convert('L'))
+            # Warms the decode cache for the generation step
+            rotation = self.rotation_combo.get_active() * 90
+            return np.array(decode_image(image_path, MAX_PIXEL_WIDTH, rotation))
         return None
 
 class SettingsDialog(Gtk.Dialog):
@@ -925,6 +3194,26 @@ class SettingsDialog(Gtk.Dialog):
         self.waterfall_top_down = Gtk.CheckButton(label="Waterfall Top-Down")
         self.waterfall_top_down.set_active(True)
         self.waterfall_top_down.connect("toggled", self.on_waterfall_top_down_toggle)
+        queue_gap_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        queue_gap_label = Gtk.Label(label="Gap Between Queued Messages (s):")
+        self.queue_gap = Gtk.SpinButton.new_with_range(0, 10, 0.5)
+        self.queue_gap.set_value(parent.transmit_queue.gap)
+        self.queue_gap.connect("value-changed", self.on_queue_gap_changed)
+        queue_gap_box.pack_start(queue_gap_label, False, False, 0)
+        queue_gap_box.pack_start(self.queue_gap, False, False, 0)
+        self.normalize_loudness = Gtk.CheckButton(label="Normalize Loudness")
+        self.normalize_loudness.set_active(parent.loudness is not None)
+        self.normalize_loudness.connect("toggled", self.on_normalize_loudness_toggle)
+        sample_rate_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL, spacing=6)
+        sample_rate_label = Gtk.Label(label="Output Sample Rate (Hz):")
+        self.sample_rate = Gtk.ComboBoxText()
+        for rate in OUTPUT_SAMPLE_RATES:
+            self.sample_rate.append_text(str(rate))
+        if parent.sample_rate in OUTPUT_SAMPLE_RATES:
+            self.sample_rate.set_active(OUTPUT_SAMPLE_RATES.index(parent.sample_rate))
+        self.sample_rate.connect("changed", self.on_sample_rate_changed)
+        sample_rate_box.pack_start(sample_rate_label, False, False, 0)
+        sample_rate_box.pack_start(self.sample_rate, False, False, 0)
 
         box = self.get_content_area()
         box.set_spacing(6)
@@ -933,6 +3222,9 @@ class SettingsDialog(Gtk.Dialog):
         box.pack_start(self.show_hflip, False, False, 0)
         box.pack_start(self.show_invert, False, False, 0)
         box.pack_start(self.waterfall_top_down, False, False, 0)
+        box.pack_start(queue_gap_box, False, False, 0)
+        box.pack_start(self.normalize_loudness, False, False, 0)
+        box.pack_start(sample_rate_box, False, False, 0)
         self.show_all()
 
     def on_tx_bandwidth_toggle(self, widget):
@@ -975,18 +3267,244 @@ class SettingsDialog(Gtk.Dialog):
         self.parent.waterfall_top_down = widget.get_active()
         self.parent.waterfall_area.queue_draw()
 
+    def on_queue_gap_changed(self, widget):
+        self.parent.transmit_queue.gap = widget.get_value()
+
+    def on_normalize_loudness_toggle(self, widget):
+        self.parent.loudness = LOUDNESS_TARGET_DBFS if widget.get_active() else None
+        self.parent.schedule_prerender()
+
+    def on_sample_rate_changed(self, widget):
+        self.parent.sample_rate = OUTPUT_SAMPLE_RATES[widget.get_active()]
+        self.parent.schedule_prerender()
+
+def show_transmit_window(app, mode, stop=None):
+    """Show a minimal window with the waterfall display and a Stop button; returns its status label."""
+    # Create a minimal window to show just the waterfall display
+    waterfall_window = Gtk.Window(title="Spectrogram Transmission")
+    waterfall_window.set_default_size(400, 100)  
+    waterfall_window.set_border_width(10)
+    waterfall_window.set_position(Gtk.WindowPosition.CENTER)  # Center on screen
+    waterfall_window.set_decorated(False) # No decorations
+    
+    # Create a vertical box to hold the waterfall and status
+    vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+    waterfall_window.add(vbox)
+    
+    # Add the waterfall display area
+    waterfall_area = Gtk.DrawingArea()
+    waterfall_area.set_size_request(400, 75)  # Reduced height to 75
+    waterfall_area.connect("draw", app.draw_waterfall)
+    vbox.pack_start(waterfall_area, True, True, 0)
+    
+    # Add a status label
+    status_label = Gtk.Label(label=f"Transmitting in {mode} mode...")
+    vbox.pack_start(status_label, False, False, 0)
+
+    stop_button = Gtk.Button(label="Stop")
+    stop_button.connect("clicked", lambda widget: (stop or app.transmitter.abort)())
+    vbox.pack_start(stop_button, False, False, 0)
+    
+    # Set up the waterfall display
+    app.waterfall_area = waterfall_area
+    app.waterfall_data = []
+    
+    # Show the window
+    waterfall_window.show_all()
+    return status_label
+
+def export_ui_stats(app, path):
+    """Write the app's UI channel statistics to path as JSON."""
+    stats = app.ui.snapshot()
+    logging.debug(f"UI statistics: {json.dumps(stats)}")
+    try:
+        with open(path, 'w') as f:
+            json.dump(stats, f, indent=2)
+        print(f"UI statistics written to {path}")
+    except OSError as e:
+        print(f"Error writing UI statistics: {e}")
+
+def parse_message(message):
+    """Turn 'image:PATH' into an image item and anything else into a text item."""
+    if message.startswith('image:'):
+        return {'image_path': message[len('image:'):].strip()}
+    return {'text': message}
+
+def read_queue_messages(path):
+    """Read one message per line from path ('-' for stdin); 'image:' lines name image files."""
+    f = sys.stdin if path == '-' else open(path)
+    try:
+        messages = []
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            messages.append(parse_message(line))
+        return messages
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def decode_main(argv):
+    """Decode generated WAV files back into images and score them against their source."""
+    parser = argparse.ArgumentParser(prog='spectrogram-generator.py decode',
+                                     description='Decode spectrogram WAV files and score them against the input')
+    parser.add_argument('wav', nargs='+', help='WAV files to decode (scored together as one batch)')
+    parser.add_argument('--text', help='Text the files were generated from')
+    parser.add_argument('--image', help='Image file the files were generated from')
+    parser.add_argument('--font-size', type=int, default=50, help='Font size for text')
+    parser.add_argument('--hflip', type=int, default=0, help='Horizontally flip the image')
+    parser.add_argument('--invert', type=int, default=1, help='Invert the colors')
+    parser.add_argument('--rotation', type=int, default=0, help='Rotate the image')
+    parser.add_argument('--compact', action='store_true', help='The files were generated with --compact')
+    parser.add_argument('--mode', default='USB', help='Radio mode the files were generated for (USB or LSB)')
+    parser.add_argument('--duration', type=float, default=0.10, help='Seconds per image row')
+    parser.add_argument('--width', type=int, default=MAX_PIXEL_WIDTH, help='Columns to decode when there is no input to score against')
+    parser.add_argument('--save', action='store_true', help='Write each decoded image next to its WAV file as .decoded.png')
+    args = parser.parse_args(argv)
+
+    try:
+        reference = None
+        if args.text or args.image:
+            if args.image and not os.path.exists(args.image):
+                print(f"Error: Image file not found: {args.image}")
+                return 1
+            reference = reference_image(args.text, args.image, font_size=args.font_size, hflip=args.hflip,
+                                        invert=args.invert, rotation=args.rotation, compact=args.compact)
+            decoded, scores = score_spectrogram(args.wav, reference, mode=args.mode, hflip=args.hflip,
+                                                duration=args.duration)
+        else:
+            decoded = [decode_samples(x, args.width, effective_flip=orientation_flip(args.mode, args.hflip),
+                                      sampleRate=rate, duration=args.duration)
+                       for x, rate in map(read_wav, args.wav)]
+    except Exception as e:
+        print(f"Error decoding spectrogram: {e}")
+        return 1
+
+    for i, path in enumerate(args.wav):
+        if reference is not None:
+            print(f"{path}: PSNR {scores['psnr'][i]:.2f} dB, SSIM {scores['ssim'][i]:.4f}")
+        if args.save:
+            pixels = (normalize_rows(decoded[i]) * 255).astype(np.uint8)
+            Image.fromarray(pixels, 'L').save(os.path.splitext(path)[0] + '.decoded.png')
+    return 0
+
+def golden_main(argv):
+    """Check a synthesis backend against the golden corpus, or regenerate the corpus."""
+    parser = argparse.ArgumentParser(prog='spectrogram-generator.py golden',
+                                     description='Compare synthesis output against the stored golden corpus')
+    parser.add_argument('--backend', choices=SYNTH_BACKENDS, default=DEFAULT_BACKEND, help='Synthesis engine to check')
+    parser.add_argument('--tolerance', type=float, help='Largest allowed per-sample difference (default: the corpus tolerance)')
+    parser.add_argument('--dir', default=GOLDEN_DIR, help='Corpus directory')
+    parser.add_argument('--update', action='store_true', help='Regenerate the corpus with the reference backend')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.update:
+            update_golden(args.dir)
+            print(f"Golden corpus written to {args.dir}")
+            return 0
+        results = check_golden(args.backend, args.tolerance, args.dir)
+    except Exception as e:
+        print(f"Error checking golden corpus: {e}")
+        return 1
+
+    for result in results:
+        status = 'ok' if result['passed'] else 'FAIL'
+        seed = '' if result['seed_ok'] else ', derived phase seed differs from the corpus'
+        print(f"{result['name']}: {status} (max difference {result['max_diff']:g}, SNR {result['snr_db']:.1f} dB{seed})")
+    failed = [r['name'] for r in results if not r['passed']]
+    print(f"Backend '{args.backend}': {len(results) - len(failed)}/{len(results)} cases match")
+    return 1 if failed else 0
+
+def bench_resample_main(argv):
+    """Benchmark low-rate synthesis plus polyphase upsampling against direct synthesis."""
+    parser = argparse.ArgumentParser(prog='spectrogram-generator.py bench-resample',
+                                     description='Compare direct synthesis at the output rate with low-rate synthesis plus upsampling')
+    parser.add_argument('--text', default='CQ DE W2JON', help='Text to render')
+    parser.add_argument('--sample-rate', type=int, default=48000, help='Output sample rate to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (the best is kept)')
+    parser.add_argument('--backend', choices=SYNTH_BACKENDS, default=DEFAULT_BACKEND, help='Synthesis engine')
+    args = parser.parse_args(argv)
+
+    try:
+        r = benchmark_resampling(args.text, args.sample_rate, args.repeat, backend=args.backend)
+    except Exception as e:
+        print(f"Error running benchmark: {e}")
+        return 1
+    print(f"Direct synthesis at {r['sample_rate']} Hz: {r['direct_s'] * 1000:.1f} ms")
+    print(f"Synthesis at {r['synthesis_rate']} Hz: {r['low_rate_synthesis_s'] * 1000:.1f} ms"
+          f" + upsampling: {r['upsample_s'] * 1000:.1f} ms ({r['speedup']:.1f}x faster)")
+    for name in ('direct', 'resampled'):
+        print(f"  {name}: decoded SSIM {r[name]['ssim']:.4f}, out-of-band energy {r[name]['out_of_band_db']:.1f} dB")
+    return 0
+
+def calibrate_main(argv):
+    """Benchmark the pipeline stages on this machine and store the profile the render governor uses."""
+    parser = argparse.ArgumentParser(prog='spectrogram-generator.py calibrate',
+                                     description='Measure how fast this machine runs each pipeline stage')
+    parser.add_argument('--profile', default=PROFILE_PATH, help='Where to store the profile')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement (the best is kept)')
+    args = parser.parse_args(argv)
+
+    print("Calibrating...")
+    try:
+        profile = calibrate(args.repeat)
+        save_profile(profile, args.profile)
+    except Exception as e:
+        print(f"Error calibrating: {e}")
+        return 1
+    print(f"Preprocessing: {profile['preprocess_per_pixel'] * 1e6:.2f} us per pixel")
+    for backend, cost in profile['synthesis'].items():
+        speedup = ', '.join(f"{n} workers {x:.2f}x" for n, x in cost['speedup'].items() if n != '1') or 'single CPU'
+        print(f"Synthesis ({backend}): {cost['per_row'] * 1000:.2f} ms per row + "
+              f"{cost['per_tone_sample'] * 1e9:.1f} ns per tone sample ({speedup})")
+    print(f"Resampling: {profile['resample_per_sample'] * 1e9:.1f} ns, WAV writing: {profile['write_per_sample'] * 1e9:.1f} ns, "
+          f"loudness: {profile['normalize_per_sample'] * 1e9:.1f} ns per output sample")
+    print(f"Profile written to {args.profile}")
+    return 0
+
+# Command-line subcommands that replace the usual generate/transmit run
+SUBCOMMANDS = {'decode': decode_main, 'golden': golden_main, 'bench-resample': bench_resample_main,
+               'calibrate': calibrate_main}
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        logging.getLogger().setLevel(logging.INFO)
+        sys.exit(SUBCOMMANDS[sys.argv[1]](sys.argv[2:]))
+
     parser = argparse.ArgumentParser(description='Generate a spectrogram from text or image')
     parser.add_argument('--text', help='Text to convert to spectrogram')
     parser.add_argument('--image', help='Image file to convert to spectrogram')
-    parser.add_argument('--output', default='spectrogram.wav', help='Output WAV file')
+    parser.add_argument('--output', default='spectrogram.wav', help="Output file ('-' streams to stdout)")
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='wav', help='Output format: WAV, raw 16-bit or raw 32-bit float (little-endian, mono)')
     parser.add_argument('--font-size', type=int, default=50, help='Font size for text')
     parser.add_argument('--hflip', type=int, default=0, help='Horizontally flip the image')
     parser.add_argument('--invert', type=int, default=1, help='Invert the colors')
     parser.add_argument('--rotation', type=int, default=0, help='Rotate the image')
     parser.add_argument('--transmit', action='store_true', help='Transmit the audio after generating')
+    parser.add_argument('--sample-rate', type=int, default=8000, help="Output sample rate; use the sound card's native rate to avoid ALSA rate conversion")
     parser.add_argument('--mode', help='Force radio mode (USB or LSB). If not specified, will attempt to detect from radio.')
-    parser.add_argument('--debug', action='store_true', help='Enable debug output')
+    parser.add_argument('--tile-rows', type=int, help='Process the image in horizontal bands of this many rows to bound memory use')
+    parser.add_argument('--phases', choices=PHASE_METHODS, default='random', help='How tone phases are chosen: random, or planned for a low crest factor (schroeder, clip)')
+    parser.add_argument('--peak-normalize', action='store_true', help='Scale each row by its own peak rather than by the number of tones, turning a low crest factor into level')
+    parser.add_argument('--phase-seed', type=int, help='Seed for the tone phases (default: derived from the input, so output is repeatable)')
+    parser.add_argument('--backend', choices=SYNTH_BACKENDS, default=DEFAULT_BACKEND, help='Synthesis engine')
+    parser.add_argument('--workers', type=int, default=1, help='Threads to split synthesis across (whole-image renders)')
+    parser.add_argument('--time-budget', type=float, metavar='SECONDS', help='Let the calibrated governor pick backend, workers and banding so each render finishes within this time')
+    parser.add_argument('--allow-downscale', action='store_true', help='Let the governor use a narrower image when nothing else fits the time budget')
+    parser.add_argument('--profile', default=PROFILE_PATH, help='Calibration profile for --time-budget (created on first use)')
+    parser.add_argument('--compact', action='store_true', help='Trim blank margins and merge identical rows to shorten the transmission')
+    parser.add_argument('--loudness', type=float, nargs='?', const=LOUDNESS_TARGET_DBFS, metavar='DBFS', help=f'Normalize to this RMS level for a steady transmit drive (default target {LOUDNESS_TARGET_DBFS:g} dBFS)')
+    parser.add_argument('--true-peak', type=float, default=TRUE_PEAK_CEILING_DBFS, metavar='DBFS', help='Peak ceiling, including peaks between samples, when normalizing')
+    parser.add_argument('--pack', action='append', metavar='MESSAGE', help="Send this text (or 'image:PATH') in its own sub-band; repeat to pack several into one transmission")
+    parser.add_argument('--guard-band', type=int, default=100, help='Hz left empty between packed messages')
+    parser.add_argument('--pack-align', choices=PACK_ALIGNMENTS, default='start', help='Where shorter packed messages sit in time')
+    parser.add_argument('--ticker', nargs='?', const='-', metavar='FILE', help="Scroll lines of text continuously from FILE (default stdin) while PTT stays keyed")
+    parser.add_argument('--queue', help="Transmit the messages in this file back to back, one per line ('-' for stdin, 'image:PATH' for images)")
+    parser.add_argument('--queue-gap', type=float, default=1.0, help='Seconds between queued messages while PTT stays keyed')
+    parser.add_argument('--debug', action='store_true', help='Enable debug output, the UI statistics overlay and their export')
+    parser.add_argument('--ui-stats', default='ui-stats.json', help='Where --debug writes the UI statistics on exit')
     args = parser.parse_args()
     
     # Configure logging based on debug flag
@@ -995,7 +3513,23 @@ if __name__ == "__main__":
     else:
         logging.getLogger().setLevel(logging.INFO)
 
-    if args.text or args.image:
+    # The governor needs this machine's profile; measure it once if there is none yet
+    profile = None
+    if args.time_budget is not None:
+        profile = load_profile(args.profile)
+        if profile is None:
+            logging.info("No calibration profile yet; calibrating this machine...")
+            profile = calibrate()
+            save_profile(profile, args.profile)
+
+    if args.text or args.image or args.pack:
+        if args.transmit and (args.output == '-' or args.format != 'wav'):
+            print("Error: --transmit needs a WAV output file")
+            sys.exit(1)
+        if args.output == '-':
+            # Keep messages out of the audio stream
+            sys.stdout = sys.stderr
+
         # Initialize a minimal app just for mode detection if needed
         temp_app = None
         current_mode = args.mode
@@ -1025,9 +3559,26 @@ if __name__ == "__main__":
             current_mode = "USB"
             
         # Create the spectrogram with the correct mode
-        success = create_spectrogram(text=args.text, image_path=args.image, output_file=args.output,
-                                    font_size=args.font_size, hflip=args.hflip, invert=args.invert, 
-                                    rotation=args.rotation, mode=current_mode)
+        if args.pack:
+            items = [dict(parse_message(message), font_size=args.font_size, invert=args.invert, rotation=args.rotation)
+                     for message in args.pack]
+            success = create_packed_spectrogram(items, output_file=args.output, guard_band=args.guard_band,
+                                                sampleRate=args.sample_rate, output_format=args.format,
+                                                mode=current_mode, hflip=args.hflip, align=args.pack_align,
+                                                phase_method=args.phases, phase_seed=args.phase_seed,
+                                                peak_normalize=args.peak_normalize, backend=args.backend,
+                                                loudness=args.loudness, true_peak=args.true_peak)
+        else:
+            success = create_spectrogram(text=args.text, image_path=args.image, output_file=args.output,
+                                        font_size=args.font_size, hflip=args.hflip, invert=args.invert,
+                                        rotation=args.rotation, mode=current_mode, tile_rows=args.tile_rows,
+                                        phase_method=args.phases, phase_seed=args.phase_seed, compact=args.compact,
+                                        peak_normalize=args.peak_normalize,
+                                        backend=args.backend, sampleRate=args.sample_rate,
+                                        output_format=args.format, loudness=args.loudness,
+                                        true_peak=args.true_peak, workers=args.workers,
+                                        time_budget=args.time_budget, allow_downscale=args.allow_downscale,
+                                        profile=profile)
         
         if success and args.transmit:
             if not temp_app:
@@ -1040,60 +3591,97 @@ if __name__ == "__main__":
             # Set the output file path
             temp_app.output_file = args.output
             
-            # Create a minimal window to show just the waterfall display
-            waterfall_window = Gtk.Window(title="Spectrogram Transmission")
-            waterfall_window.set_default_size(400, 100)  
-            waterfall_window.set_border_width(10)
-            waterfall_window.set_position(Gtk.WindowPosition.CENTER)  # Center on screen
-            waterfall_window.set_decorated(False) # No decorations
-            
-            # Create a vertical box to hold the waterfall and status
-            vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
-            waterfall_window.add(vbox)
-            
-            # Add the waterfall display area
-            waterfall_area = Gtk.DrawingArea()
-            waterfall_area.set_size_request(400, 75)  # Reduced height to 75
-            waterfall_area.connect("draw", temp_app.draw_waterfall)
-            vbox.pack_start(waterfall_area, True, True, 0)
-            
-            # Add a status label
-            status_label = Gtk.Label(label=f"Transmitting in {current_mode} mode...")
-            vbox.pack_start(status_label, False, False, 0)
-            
-            # Set up the waterfall display
-            temp_app.waterfall_area = waterfall_area
-            temp_app.waterfall_data = []
-            
-            # Show the window
-            waterfall_window.show_all()
+            status_label = show_transmit_window(temp_app, current_mode)
             
             # Play the audio (non-blocking)
             print(f"Transmitting audio from {args.output} in {current_mode} mode...")
-            temp_app.play_audio()
-            
-            # Set up a timer to update the status and close when done
-            def check_playback_status():
-                if not temp_app.is_playing:
-                    status_label.set_text("Transmission complete. Closing...")
-                    # Schedule window close after a short delay
-                    GLib.timeout_add(1000, Gtk.main_quit)
-                    return False  # Stop the timer
-                return True  # Continue the timer
+            done = temp_app.play_audio()
             
-            # Check status every 100ms
-            GLib.timeout_add(100, check_playback_status)
+            # Close shortly after PTT has been released
+            def on_transmit_finished(future):
+                temp_app.ui.post(status_label.set_text, "Transmission complete. Closing...")
+                temp_app.ui.post(GLib.timeout_add, 1000, Gtk.main_quit)
+            done.add_done_callback(on_transmit_finished)
             
             # Run the GTK main loop
             Gtk.main()
             
             # Clean up
+            temp_app.transmitter.shutdown()
             if temp_app and hasattr(temp_app, 'close_hamlib'):
                 temp_app.close_hamlib()
+            if args.debug:
+                export_ui_stats(temp_app, args.ui_stats)
             
             print("Transmission complete.")
         
         sys.exit(0 if success else 1)
+    elif args.ticker:
+        if not Gtk.init_check()[0]:
+            print("Error: GTK initialization failed")
+            sys.exit(1)
+        temp_app = SpectrogramApp()
+        current_mode = args.mode
+        if not current_mode:
+            print("Detecting radio mode...")
+            current_mode = temp_app.get_hamlib_mode() or "USB"
+            print(f"Detected radio mode: {current_mode}")
+
+        ticker = Ticker(font_size=args.font_size, mode=current_mode, hflip=args.hflip, backend=args.backend,
+                        sampleRate=args.sample_rate)
+        threading.Thread(target=feed_ticker, args=(ticker, args.ticker), daemon=True).start()
+        print(f"Ticker running in {current_mode} mode; end input (Ctrl-D) or press Ctrl-C to stop...")
+        # The controller keys up and always releases PTT, whichever way the ticker ends
+        done = temp_app.transmitter.start_ticker(ticker)
+        try:
+            done.result()
+        except KeyboardInterrupt:
+            temp_app.transmitter.shutdown()
+            print("Ticker stopped.")
+        temp_app.close_hamlib()
+        sys.exit(0)
+    elif args.queue:
+        messages = read_queue_messages(args.queue)
+        if not messages:
+            print("Error: No messages to transmit")
+            sys.exit(1)
+        if not Gtk.init_check()[0]:
+            print("Error: GTK initialization failed")
+            sys.exit(1)
+        temp_app = SpectrogramApp()
+        
+        current_mode = args.mode
+        if not current_mode:
+            print("Detecting radio mode...")
+            current_mode = temp_app.get_hamlib_mode() or "USB"
+            print(f"Detected radio mode: {current_mode}")
+        
+        def on_queue_finished():
+            temp_app.ui.post(status_label.set_text, "Transmission complete. Closing...")
+            temp_app.ui.post(GLib.timeout_add, 1000, Gtk.main_quit)
+        
+        transmit_queue = temp_app.transmit_queue
+        transmit_queue.gap = args.queue_gap
+        transmit_queue.on_idle = on_queue_finished
+        status_label = show_transmit_window(temp_app, current_mode, stop=transmit_queue.abort)
+        for message in messages:
+            transmit_queue.enqueue(dict(message, font_size=args.font_size, hflip=args.hflip, invert=args.invert,
+                                        rotation=args.rotation, mode=current_mode, tile_rows=args.tile_rows,
+                                        phase_method=args.phases, phase_seed=args.phase_seed,
+                                        peak_normalize=args.peak_normalize, compact=args.compact, backend=args.backend, sampleRate=args.sample_rate,
+                                        loudness=args.loudness, true_peak=args.true_peak, workers=args.workers,
+                                        time_budget=args.time_budget, allow_downscale=args.allow_downscale,
+                                        profile=profile))
+        print(f"Transmitting {len(messages)} queued messages in {current_mode} mode...")
+        
+        Gtk.main()
+        temp_app.transmitter.shutdown()
+        transmit_queue.close()
+        temp_app.close_hamlib()
+        if args.debug:
+            export_ui_stats(temp_app, args.ui_stats)
+        print("Transmission complete.")
+        sys.exit(0)
     else:
         if not Gtk.init_check()[0]:
             print("Error: GTK initialization failed")
@@ -1101,4 +3689,9 @@ if __name__ == "__main__":
         win = SpectrogramApp()
         win.connect("destroy", Gtk.main_quit)
         win.show_all()
-        Gtk.main()
\ No newline at end of file
+        Gtk.main()
+        # Closing the window mid-transmission still releases PTT
+        win.transmitter.shutdown()
+        win.transmit_queue.close()
+        if args.debug:
+            export_ui_stats(win, args.ui_stats)
\ No newline at end of file